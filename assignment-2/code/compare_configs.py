@@ -1,5 +1,6 @@
 from doc2vec import Doc2Vec
 import read_ap
+from qrels_index import load_qrels
 from tqdm import tqdm
 import pytrec_eval
 import json
@@ -10,7 +11,7 @@ vector_dims = [300, 400, 500]
 # for each vocabulary size, the following min_count values approximate them {10: 250, 25: 50, 50: 15, 100: 5, 200: 2}
 vocab_dict = {250:'10k', 50: '25k', 15: '50k', 5: '100k', 2: '200k'}
 vocab_sizes = {250, 50, 15, 5, 2}
-qrels, queries = read_ap.read_qrels()
+qrels, queries = load_qrels().as_dicts()
 evaluator = pytrec_eval.RelevanceEvaluator(qrels, {'map', 'ndcg'})
 maps = {}
 ndcgs = []
@@ -1,11 +1,12 @@
 from doc2vec import Doc2Vec
 import read_ap
+from qrels_index import load_qrels
 from tqdm import tqdm
 import pytrec_eval
 import json
 
 # get queries
-qrels, queries = read_ap.read_qrels()
+qrels, queries = load_qrels().as_dicts()
 
 vec_dim_def = 300
 wind_size_def = 15
@@ -29,6 +29,8 @@ class Doc2Vec:
         print('done training')
         model.delete_temporary_training_data(keep_doctags_vectors=True, keep_inference=True)
         self.model = model
+        # bumped whenever the document vectors are recomputed, see result_cache.py
+        self.version = 0
 
     def read_docs(self, docs):
         corpus = []
@@ -65,6 +67,7 @@ class Doc2Vec:
         print(doc_vecs.shape)
         self.doc_vecs = doc_vecs
         self.idx2docid = idx2docid
+        self.version += 1
 
     def search(self, query):
         query_repr = read_ap.process_text(query)
@@ -17,6 +17,7 @@ from doc2vec import Doc2Vec
 
 from collections import defaultdict, Counter
 from tf_idf import TfIdfRetrieval
+from qrels_index import load_qrels
 
 
 # In[2]:
@@ -66,7 +67,7 @@ def perform_ttest(m1, m2, metric, models, thresh=0.05, print_res=True):
 #read data
 
 docs = read_ap.get_processed_docs()
-qrels, queries = read_ap.read_qrels()
+qrels, queries = load_qrels().as_dicts()
 
 print('done reading data')
 # In[4]:
@@ -16,6 +16,8 @@ def kl_divergence(p, q):
 class LDARetrieval():
 
     def __init__(self, docs, get_model=False, num_topics=10, passes=6, iterations=40, prep_search=False):
+      # bumped whenever a new model is trained or loaded, see result_cache.py
+      self.version = 0
         
       fDICT = "./models/lda_dict.dat"
 
@@ -56,6 +58,7 @@ class LDARetrieval():
                             eval_every=eval_every)
       model.save(fmodel + ".pt")
       self.model = model
+      self.version += 1
 
 #       p = re.compile("(-*\d+\.\d+) per-word .* (\d+\.\d+) perplexity")
 #       matches = [p.findall(l) for l in open(fmodel+'.log')]
@@ -98,6 +101,7 @@ class LDARetrieval():
         print("Model not found...")
         return None
       self.model = LdaModel.load(fname + ".pt")
+      self.version += 1
       if prep_search:
         self.prepare_search(docs)
       return self.model
@@ -2,6 +2,7 @@ import read_ap
 import download_ap
 from utils import bow2tfidf
 from evaluate import evaluate_model
+from qrels_index import load_qrels
 
 import numpy as np
 import os
@@ -24,6 +25,8 @@ class LSI():
         self.no_above = no_above
         self.tfidf = tfidf
         self.model_path = model_path
+        # bumped on every (re)training, so cached rankings of older models are not reused
+        self.version = 0
 
         if not os.path.exists(model_path):
             os.makedirs(model_path)
@@ -57,6 +60,7 @@ class LSI():
             num_topics=self.num_topics
         )
         self.model = lsi_model
+        self.version += 1
         print("done.")
         return lsi_model
 
@@ -114,7 +118,7 @@ if __name__ == "__main__":
 
     # read in the qrels
     print("read in queries...")
-    qrels, queries = read_ap.read_qrels()
+    qrels, queries = load_qrels().as_dicts()
     print("done")
 
     lsi = LSI(docs_by_id, num_topics=10, tfidf=True, model_path="./lsi_data_")
@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+
+import read_ap
+
+
+QRELS_CACHE_PATH = "./qrels_index.npz"
+
+# indices that were already loaded in this process, keyed on the cache path
+_loaded = {}
+
+
+class QrelsIndex():
+    """
+    Compact, integer-indexed view of the AP relevance judgements and queries.
+
+    Doc ids are mapped to positions in the sorted `doc_ids` vocabulary and the
+    judgements are stored per query in CSR form: the judged docs of the query
+    at position q are `doc_index[indptr[q]:indptr[q+1]]` (sorted), with their
+    relevance in the same slice of `relevance`. Pre-processed query tokens are
+    stored the same way against the `vocab` array.
+    """
+
+    def __init__(self, qids, doc_ids, indptr, doc_index, relevance,
+                 query_texts, vocab, token_indptr, token_index):
+        self.qids = qids
+        self.doc_ids = doc_ids
+        self.indptr = indptr
+        self.doc_index = doc_index
+        self.relevance = relevance
+        self.query_texts = query_texts
+        self.vocab = vocab
+        self.token_indptr = token_indptr
+        self.token_index = token_index
+
+        self.qid2pos = {str(qid): pos for pos, qid in enumerate(self.qids)}
+        self._dicts = None
+
+    @classmethod
+    def build(cls, root_folder="./datasets/"):
+        qrels, queries = read_ap.read_qrels(root_folder)
+        qids = sorted(qrels)
+
+        doc_ids = np.array(sorted({doc_id for qid in qids for doc_id in qrels[qid]}), dtype=str)
+        indptr = np.zeros(len(qids) + 1, dtype=np.int64)
+        doc_index = []
+        relevance = []
+        for pos, qid in enumerate(qids):
+            judged = sorted(qrels[qid])
+            doc_index.append(np.searchsorted(doc_ids, judged))
+            relevance.append([qrels[qid][doc_id] for doc_id in judged])
+            indptr[pos + 1] = indptr[pos] + len(judged)
+
+        print("Processing queries")
+        query_tokens = [read_ap.process_text(queries[qid]) for qid in qids]
+        vocab = np.array(sorted({token for tokens in query_tokens for token in tokens}), dtype=str)
+        token_indptr = np.zeros(len(qids) + 1, dtype=np.int64)
+        token_indptr[1:] = np.cumsum([len(tokens) for tokens in query_tokens])
+        token_index = np.array([np.searchsorted(vocab, token) for tokens in query_tokens for token in tokens],
+                               dtype=np.int32)
+
+        return cls(np.array(qids, dtype=str),
+                   doc_ids,
+                   indptr,
+                   np.concatenate(doc_index).astype(np.int32),
+                   np.concatenate(relevance).astype(np.int8),
+                   np.array([queries[qid] for qid in qids], dtype=str),
+                   vocab,
+                   token_indptr,
+                   token_index)
+
+    def save(self, path=QRELS_CACHE_PATH):
+        np.savez(path,
+                 qids=self.qids,
+                 doc_ids=self.doc_ids,
+                 indptr=self.indptr,
+                 doc_index=self.doc_index,
+                 relevance=self.relevance,
+                 query_texts=self.query_texts,
+                 vocab=self.vocab,
+                 token_indptr=self.token_indptr,
+                 token_index=self.token_index)
+
+    @classmethod
+    def load(cls, path=QRELS_CACHE_PATH):
+        with np.load(path) as cached:
+            return cls(**{name: cached[name] for name in cached.files})
+
+    def __len__(self):
+        return self.qids.shape[0]
+
+    def __contains__(self, qid):
+        return qid in self.qid2pos
+
+    def __iter__(self):
+        return iter(self.qid2pos)
+
+    def judged_docs(self, qid):
+        """
+        Returns the judged doc ids of a query (sorted) and their relevance
+        """
+        pos = self.qid2pos[qid]
+        s_i, e_i = self.indptr[pos], self.indptr[pos + 1]
+        return self.doc_ids[self.doc_index[s_i:e_i]], self.relevance[s_i:e_i]
+
+    def get_relevance(self, qid, doc_id):
+        """
+        Returns the relevance of doc_id for qid, 0 if it is not judged
+        """
+        pos = self.qid2pos[qid]
+        s_i, e_i = self.indptr[pos], self.indptr[pos + 1]
+        judged = self.doc_ids[self.doc_index[s_i:e_i]]
+        i = np.searchsorted(judged, doc_id)
+        if i < judged.shape[0] and judged[i] == doc_id:
+            return int(self.relevance[s_i + i])
+        return 0
+
+    def query_text(self, qid):
+        return str(self.query_texts[self.qid2pos[qid]])
+
+    def query_tokens(self, qid):
+        """
+        Returns the query as processed by read_ap.process_text
+        """
+        pos = self.qid2pos[qid]
+        s_i, e_i = self.token_indptr[pos], self.token_indptr[pos + 1]
+        return [str(token) for token in self.vocab[self.token_index[s_i:e_i]]]
+
+    def as_dicts(self):
+        """
+        Returns (qrels, queries) in the format of read_ap.read_qrels,
+        e.g. to pass the judgements to pytrec_eval
+        """
+        if self._dicts is None:
+            qrels = {}
+            queries = {}
+            for qid in self.qid2pos:
+                doc_ids, relevance = self.judged_docs(qid)
+                qrels[qid] = {str(doc_id): int(rel) for doc_id, rel in zip(doc_ids, relevance)}
+                queries[qid] = self.query_text(qid)
+            self._dicts = (qrels, queries)
+        return self._dicts
+
+
+def load_qrels(root_folder="./datasets/", cache_path=QRELS_CACHE_PATH):
+    """
+    Returns the QrelsIndex, parsing the qrels and queries only if no cache exists yet
+    """
+    if cache_path not in _loaded:
+        if os.path.exists(cache_path):
+            index = QrelsIndex.load(cache_path)
+        else:
+            index = QrelsIndex.build(root_folder)
+            index.save(cache_path)
+        _loaded[cache_path] = index
+    return _loaded[cache_path]
@@ -0,0 +1,148 @@
+import os
+import hashlib
+import pickle as pkl
+from collections import OrderedDict
+
+import read_ap
+
+
+class ResultCache():
+    """
+    LRU cache in front of the `search`/`rank` method of any of the retrieval models.
+
+    Results are keyed on (model id, model fingerprint, processed query tokens, k).
+    The fingerprint hashes the model's type, its scalar attributes (the hyperparameters
+    and the `version` that is bumped when the model is retrained or its index updated)
+    and the contents of `files`, the index/model files the model was built from.
+    The version alone restarts at 0 in every process, so a saved cache is only loaded
+    when its fingerprint matches the one of the model it is put in front of.
+    """
+
+    def __init__(self, model, model_id=None, capacity=1024, cache_path=None, files=()):
+        self.model = model
+        self.model_id = model_id if model_id is not None else type(model).__name__
+        self.capacity = capacity
+        self.cache_path = cache_path
+        self.files_digest = files_digest(files)
+        self._fingerprint = None
+        self._fingerprint_version = None
+
+        self.results = OrderedDict()
+        # process_text is slow too, so remember the tokens of raw queries as well
+        self.query_tokens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "rb") as reader:
+                cached = pkl.load(reader)
+            if not isinstance(cached, dict) or cached.get("fingerprint") != self.fingerprint():
+                print(f"Not loading the result cache {cache_path}, it was saved for another model or index")
+            else:
+                self.results.update(cached["results"])
+                self._evict()
+
+    def fingerprint(self):
+        """
+        Hash of the model's type, scalar attributes and files, recomputed when its version changes
+        """
+        version = getattr(self.model, "version", None)
+        if self._fingerprint is None or version != self._fingerprint_version:
+            config = sorted((name, value) for name, value in vars(self.model).items()
+                            if not name.startswith("_") and isinstance(value, (bool, int, float, str, type(None))))
+            if "version" not in vars(self.model):
+                # e.g. a property that reads the version of the index
+                config.append(("version", version))
+            digest = hashlib.sha1(repr((type(self.model).__name__, config)).encode("utf-8"))
+            digest.update(self.files_digest.encode("utf-8"))
+            self._fingerprint = digest.hexdigest()
+            self._fingerprint_version = version
+        return self._fingerprint
+
+    def _evict(self):
+        while len(self.results) > self.capacity:
+            self.results.popitem(last=False)
+        while len(self.query_tokens) > self.capacity:
+            self.query_tokens.popitem(last=False)
+
+    def _tokens(self, query):
+        if not isinstance(query, str):
+            return tuple(query)
+        if query in self.query_tokens:
+            self.query_tokens.move_to_end(query)
+        else:
+            self.query_tokens[query] = tuple(read_ap.process_text(query))
+        return self.query_tokens[query]
+
+    def _lookup(self, query, k, compute):
+        tokens = self._tokens(query)
+        key = (self.model_id, self.fingerprint(), tokens, k)
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        self.misses += 1
+        results = compute(query, tokens)
+        if k is not None:
+            results = results[:k]
+        self.results[key] = results
+        self._evict()
+        return results
+
+    def search(self, query, k=None):
+        """
+        Cached `model.search`. The query can be a raw string or a list of processed tokens
+        """
+        def compute(query, tokens):
+            # skip process_text if the model can score processed tokens directly
+            if hasattr(self.model, "search_tokens"):
+                return self.model.search_tokens(list(tokens))
+            return self.model.search(query)
+        return self._lookup(query, k, compute)
+
+    def rank(self, query, k=None, **kwargs):
+        """
+        Cached `model.rank`, extra keyword arguments are passed on to the model on a miss.
+        The models process the query themselves, so it has to be a raw string
+        """
+        if not isinstance(query, str):
+            raise TypeError(f"rank takes the raw query string, got {type(query).__name__}")
+        return self._lookup(query, k, lambda query, tokens: self.model.rank(query, **kwargs))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+            "size": len(self.results),
+            "capacity": self.capacity,
+        }
+
+    def clear(self):
+        self.results.clear()
+        self.query_tokens.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path=None):
+        path = path if path is not None else self.cache_path
+        assert path is not None, "No path given to save the result cache to"
+        # only the results of the model as it is now, those of older versions can never be hit again
+        fingerprint = self.fingerprint()
+        results = OrderedDict((key, value) for key, value in self.results.items() if key[1] == fingerprint)
+        with open(path, "wb") as writer:
+            pkl.dump({"fingerprint": fingerprint, "results": results}, writer)
+
+
+def files_digest(paths):
+    """
+    SHA-1 of the contents of the given files, in order
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as reader:
+            for block in iter(lambda: reader.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
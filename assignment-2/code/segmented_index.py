@@ -0,0 +1,293 @@
+import os
+import json
+import pickle as pkl
+from collections import defaultdict, Counter
+
+import numpy as np
+
+
+class Segment():
+    """
+    Immutable inverted index over a batch of documents.
+
+    Postings are stored per term as two arrays: the positions of the
+    documents in `doc_ids` and their term frequencies. Deletes never touch
+    the postings, they only set the document's bit in `deleted`, so the
+    document frequencies `df` count the deleted documents as well.
+    """
+
+    def __init__(self, seg_id, doc_ids, postings, doc_terms, deleted=None, df=None):
+        self.seg_id = seg_id
+        self.doc_ids = doc_ids
+        self.postings = postings
+        # unique terms per document, needed to keep df up to date on deletes
+        self.doc_terms = doc_terms
+        self.deleted = deleted if deleted is not None else np.zeros(len(doc_ids), dtype=bool)
+        self.df = df if df is not None else {t: len(docs) for t, (docs, _) in postings.items()}
+
+    @classmethod
+    def from_counts(cls, seg_id, doc_counts):
+        """
+        Build a segment from {doc_id: Counter(term: tf)}
+        """
+        doc_ids = list(doc_counts.keys())
+        postings = defaultdict(lambda: ([], []))
+        for i, doc_id in enumerate(doc_ids):
+            for t, c in doc_counts[doc_id].items():
+                postings[t][0].append(i)
+                postings[t][1].append(c)
+        postings = {t: (np.array(docs, dtype=np.int32), np.array(tfs, dtype=np.int32))
+                    for t, (docs, tfs) in postings.items()}
+        doc_terms = [tuple(doc_counts[doc_id]) for doc_id in doc_ids]
+        return cls(seg_id, doc_ids, postings, doc_terms)
+
+    @classmethod
+    def merge(cls, seg_id, segments):
+        """
+        Merge segments into a new one, dropping the deleted documents
+        """
+        doc_ids = []
+        doc_terms = []
+        remaps = []
+        for segment in segments:
+            alive = ~segment.deleted
+            remap = np.full(len(segment), -1, dtype=np.int64)
+            remap[alive] = np.arange(np.sum(alive)) + len(doc_ids)
+            remaps.append(remap)
+            doc_ids.extend(d for d, a in zip(segment.doc_ids, alive) if a)
+            doc_terms.extend(t for t, a in zip(segment.doc_terms, alive) if a)
+
+        parts = defaultdict(list)
+        for segment, remap in zip(segments, remaps):
+            for t, (docs, tfs) in segment.postings.items():
+                new_docs = remap[docs]
+                keep = new_docs >= 0
+                if np.any(keep):
+                    parts[t].append((new_docs[keep].astype(np.int32), tfs[keep]))
+        postings = {t: (np.concatenate([p[0] for p in ps]), np.concatenate([p[1] for p in ps]))
+                    for t, ps in parts.items()}
+        return cls(seg_id, doc_ids, postings, doc_terms)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def num_alive(self):
+        return len(self.doc_ids) - int(np.sum(self.deleted))
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as writer:
+            pkl.dump({"doc_ids": self.doc_ids, "postings": self.postings, "doc_terms": self.doc_terms,
+                      "df": self.df}, writer)
+        os.replace(tmp_path, path)
+
+    def save_deleted(self, path):
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, self.deleted)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, seg_id, path, deleted_path):
+        with open(path, "rb") as reader:
+            data = pkl.load(reader)
+        deleted = np.load(deleted_path) if os.path.exists(deleted_path) else None
+        # segments written before df was stored get it from their postings
+        return cls(seg_id, data["doc_ids"], data["postings"], data["doc_terms"], deleted, data.get("df"))
+
+
+class SegmentedIndex():
+    """
+    Log-structured inverted index that can be updated without a full rebuild.
+
+    New documents go into an in-memory buffer, which is written to disk as an
+    immutable segment once it holds `flush_every` documents (or on `flush()`).
+    Whenever `merge_factor` segments of similar size exist they are merged into
+    one, so the number of segments stays logarithmic in the collection size.
+    Document frequencies are kept up to date over all segments and the buffer.
+
+    `version` is bumped on every change. The manifest holds a version that is
+    at least as high as any version handed out, reserved ahead in steps of
+    `flush_every`, so an index reopened after unflushed changes never reports
+    a version that was used for other contents before.
+    """
+
+    def __init__(self, index_dir="./tfidf_segments", flush_every=1000, merge_factor=4):
+        self.index_dir = index_dir
+        self.flush_every = flush_every
+        self.merge_factor = merge_factor
+        os.makedirs(index_dir, exist_ok=True)
+
+        self.segments = []
+        self.next_seg_id = 0
+        self.version = 0
+        manifest_path = self._manifest_path()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as reader:
+                manifest = json.load(reader)
+            self.next_seg_id = manifest["next_segment"]
+            self.version = manifest["version"]
+            for seg_id in manifest["segments"]:
+                self.segments.append(Segment.load(seg_id, self._segment_path(seg_id),
+                                                  self._deleted_path(seg_id)))
+
+        # in-memory buffer of documents that are not flushed yet
+        self.buffer = {}
+        self.buffer_ii = defaultdict(dict)
+        self._dirty_deletes = set()
+
+        self._reserved_version = self.version
+
+        # merge the df of the segments, and take the deleted documents out again
+        self.df = defaultdict(int)
+        self.doc_location = {}
+        for segment in self.segments:
+            for t, n in segment.df.items():
+                self.df[t] += n
+            for i in np.flatnonzero(segment.deleted):
+                for t in segment.doc_terms[i]:
+                    self.df[t] -= 1
+            self.doc_location.update((doc_id, (segment, i)) for i, doc_id in enumerate(segment.doc_ids)
+                                     if not segment.deleted[i])
+        for t in [t for t, n in self.df.items() if n == 0]:
+            del self.df[t]
+
+    def _manifest_path(self):
+        return os.path.join(self.index_dir, "manifest.json")
+
+    def _segment_path(self, seg_id):
+        return os.path.join(self.index_dir, "seg_{}.pkl".format(seg_id))
+
+    def _deleted_path(self, seg_id):
+        return os.path.join(self.index_dir, "seg_{}.del.npy".format(seg_id))
+
+    def _write_manifest(self):
+        manifest = {
+            "segments": [segment.seg_id for segment in self.segments],
+            "next_segment": self.next_seg_id,
+            "version": self._reserved_version,
+        }
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, "w") as writer:
+            json.dump(manifest, writer)
+        os.replace(tmp_path, self._manifest_path())
+
+    def _bump_version(self):
+        self.version += 1
+        if self.version > self._reserved_version:
+            self._reserved_version = self.version + self.flush_every
+            self._write_manifest()
+
+    def __len__(self):
+        return len(self.doc_location) + len(self.buffer)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.buffer or doc_id in self.doc_location
+
+    def add_document(self, doc_id, tokens):
+        """
+        Add (or replace) a document given its processed tokens
+        """
+        if doc_id in self:
+            self.delete_document(doc_id)
+        counts = Counter(tokens)
+        self.buffer[doc_id] = counts
+        for t, c in counts.items():
+            self.buffer_ii[t][doc_id] = c
+            self.df[t] += 1
+        self._bump_version()
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def delete_document(self, doc_id):
+        """
+        Delete a document, returns False (and changes nothing) if it is not indexed
+        """
+        if doc_id not in self:
+            return False
+        if doc_id in self.buffer:
+            terms = self.buffer.pop(doc_id)
+            for t in terms:
+                del self.buffer_ii[t][doc_id]
+                if not self.buffer_ii[t]:
+                    del self.buffer_ii[t]
+        else:
+            segment, i = self.doc_location.pop(doc_id)
+            segment.deleted[i] = True
+            terms = segment.doc_terms[i]
+            self._dirty_deletes.add(segment)
+        for t in terms:
+            self.df[t] -= 1
+            if self.df[t] == 0:
+                del self.df[t]
+        self._bump_version()
+        return True
+
+    def flush(self):
+        """
+        Write the buffer as a new segment and persist pending deletes
+        """
+        if self.buffer:
+            segment = Segment.from_counts(self.next_seg_id, self.buffer)
+            self.next_seg_id += 1
+            segment.save(self._segment_path(segment.seg_id))
+            self.segments.append(segment)
+            for i, doc_id in enumerate(segment.doc_ids):
+                self.doc_location[doc_id] = (segment, i)
+            self.buffer = {}
+            self.buffer_ii = defaultdict(dict)
+        for segment in self._dirty_deletes:
+            if segment in self.segments:
+                segment.save_deleted(self._deleted_path(segment.seg_id))
+        self._dirty_deletes = set()
+        self._maybe_merge()
+        # everything is on disk now, so the version needs no reservation
+        self._reserved_version = self.version
+        self._write_manifest()
+
+    def _tier(self, segment):
+        # segments within a factor `merge_factor` of each other share a tier
+        return int(np.log(max(segment.num_alive(), 1) / self.flush_every + 1) / np.log(self.merge_factor))
+
+    def _maybe_merge(self):
+        merged = True
+        while merged:
+            merged = False
+            tiers = defaultdict(list)
+            for segment in self.segments:
+                tiers[self._tier(segment)].append(segment)
+            for tier in sorted(tiers):
+                if len(tiers[tier]) >= self.merge_factor:
+                    self._merge(tiers[tier][:self.merge_factor])
+                    merged = True
+                    break
+
+    def _merge(self, to_merge):
+        segment = Segment.merge(self.next_seg_id, to_merge)
+        self.next_seg_id += 1
+        segment.save(self._segment_path(segment.seg_id))
+        for i, doc_id in enumerate(segment.doc_ids):
+            self.doc_location[doc_id] = (segment, i)
+        position = self.segments.index(to_merge[0])
+        self.segments = [s for s in self.segments if s not in to_merge]
+        self.segments.insert(position, segment)
+        # only remove the old files once the manifest points at the merged segment
+        self._write_manifest()
+        for old in to_merge:
+            for path in (self._segment_path(old.seg_id), self._deleted_path(old.seg_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def postings(self, term):
+        """
+        Yields (doc_ids, tfs) for the term, one pair per segment plus the buffer,
+        with deleted documents filtered out
+        """
+        for segment in self.segments:
+            if term not in segment.postings:
+                continue
+            docs, tfs = segment.postings[term]
+            alive = ~segment.deleted[docs]
+            yield [segment.doc_ids[i] for i in docs[alive]], tfs[alive]
+        if term in self.buffer_ii:
+            buffered = self.buffer_ii[term]
+            yield list(buffered.keys()), np.fromiter(buffered.values(), dtype=np.int32, count=len(buffered))
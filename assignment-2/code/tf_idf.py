@@ -1,14 +1,18 @@
 import os
+import abc
 import json
 import pickle as pkl
 from collections import defaultdict, Counter
 
 import numpy as np
 import pytrec_eval
+import scipy.sparse
 from tqdm import tqdm
 
 import read_ap
 import download_ap
+from qrels_index import load_qrels
+from segmented_index import SegmentedIndex
 
 
 
@@ -24,6 +28,8 @@ def print_results(docs, query, n_docs_limit=10, len_limit=50):
 class TfIdfRetrieval():
 
     def __init__(self, docs):
+        # the index never changes once built, see result_cache.py
+        self.version = 0
         
         index_path = "./tfidf_index"
         if os.path.exists(index_path):
@@ -58,9 +64,12 @@ class TfIdfRetrieval():
                 }
                 pkl.dump(index, writer) 
 
-    def search(self, query):
-        query_repr = read_ap.process_text(query)
+        self._arrays = None
 
+    def search(self, query, k=None):
+        return self.search_tokens(read_ap.process_text(query), k)
+
+    def search_tokens(self, query_repr, k=None):
         results = defaultdict(float)
         for query_term in query_repr:
             if query_term not in self.ii:
@@ -70,9 +79,260 @@ class TfIdfRetrieval():
 
         results = list(results.items())
         results.sort(key=lambda _: -_[1])
+        return results[:k]
+
+    def search_batch(self, queries, k=None):
+        return [self.search(query, k) for query in queries]
+
+    def arrays(self):
+        """
+        Returns the index as InvertedIndexArrays, built on first use
+        """
+        if self._arrays is None:
+            self._arrays = InvertedIndexArrays(self.ii)
+        return self._arrays
+
+
+class IncrementalTfIdfRetrieval():
+    """
+    TF-IDF retrieval over a SegmentedIndex, so documents can be added and
+    deleted without rebuilding and re-pickling the whole inverted index.
+    Scores are the same as those of TfIdfRetrieval over the same documents.
+    """
+
+    def __init__(self, docs=None, index_dir="./tfidf_segments", flush_every=1000, merge_factor=4):
+        self.index = SegmentedIndex(index_dir, flush_every=flush_every, merge_factor=merge_factor)
+        if docs is not None:
+            # only index what is not on disk yet
+            self.add_documents(docs, replace=False)
+            self.flush()
+
+    @property
+    def version(self):
+        return self.index.version
+
+    def add_documents(self, docs, replace=True):
+        """
+        Index the given {doc_id: tokens}, replacing documents that are already indexed if `replace`
+        """
+        for doc_id, doc in tqdm(docs.items()):
+            if not replace and doc_id in self.index:
+                continue
+            self.index.add_document(doc_id, doc)
+
+    def delete_documents(self, doc_ids):
+        for doc_id in doc_ids:
+            self.index.delete_document(doc_id)
+
+    def flush(self):
+        self.index.flush()
+
+    def search(self, query, k=None):
+        return self.search_tokens(read_ap.process_text(query), k)
+
+    def search_tokens(self, query_repr, k=None):
+        results = defaultdict(float)
+        for query_term in query_repr:
+            if query_term not in self.index.df:
+                continue
+            df = self.index.df[query_term]
+            for (doc_ids, tfs) in self.index.postings(query_term):
+                for doc_id, weight in zip(doc_ids, np.log(1 + tfs) / df):
+                    results[doc_id] += weight
+
+        results = list(results.items())
+        results.sort(key=lambda _: -_[1])
+        return results[:k]
+
+    def search_batch(self, queries, k=None):
+        return [self.search(query, k) for query in queries]
+
+
+class InvertedIndexArrays():
+    """
+    The inverted index as a sparse term x document matrix of term frequencies,
+    with the document lengths and collection statistics precomputed
+    """
+
+    def __init__(self, ii):
+        self.terms = list(ii.keys())
+        self.term2id = {t: i for i, t in enumerate(self.terms)}
+        self.doc_ids = sorted({doc_id for postings in ii.values() for (doc_id, _) in postings})
+        doc2id = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+
+        indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(ii[t]) for t in self.terms])
+        indices = np.fromiter((doc2id[doc_id] for t in self.terms for (doc_id, _) in ii[t]),
+                              dtype=np.int32, count=indptr[-1])
+        tfs = np.fromiter((tf for t in self.terms for (_, tf) in ii[t]),
+                          dtype=np.float64, count=indptr[-1])
+        self.tf = scipy.sparse.csr_matrix((tfs, indices, indptr), shape=(len(self.terms), len(self.doc_ids)))
+
+        self.df = np.diff(self.tf.indptr)
+        self.doc_lengths = np.asarray(self.tf.sum(axis=0)).ravel()
+        collection_freq = np.asarray(self.tf.sum(axis=1)).ravel()
+        self.collection_prob = collection_freq / collection_freq.sum()
+        # term id of every posting, aligned with self.tf.data and self.tf.indices
+        self.posting_terms = np.repeat(np.arange(len(self.terms)), self.df)
+
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def query_matrix(self, queries_repr):
+        """
+        Sparse (queries x terms) matrix of query term counts, unknown terms are dropped
+        """
+        rows, cols = [], []
+        for row, query_repr in enumerate(queries_repr):
+            for t in query_repr:
+                if t in self.term2id:
+                    rows.append(row)
+                    cols.append(self.term2id[t])
+        counts = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                         shape=(len(queries_repr), len(self.terms)))
+        counts.sum_duplicates()
+        return counts
+
+    def with_weights(self, weights):
+        """
+        Returns a matrix with the sparsity of the tf matrix and the given per-posting weights
+        """
+        return scipy.sparse.csr_matrix((weights, self.tf.indices, self.tf.indptr), shape=self.tf.shape)
+
+
+def top_k(doc_ids, candidates, scores, k=None):
+    """
+    Returns the k best (doc_id, score) pairs, sorted by descending score
+    """
+    if k == 0:
+        return []
+    if k is not None and k < candidates.shape[0]:
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(candidates.shape[0])
+    best = best[np.argsort(-scores[best], kind="stable")]
+    return [(doc_ids[candidates[i]], float(scores[i])) for i in best]
+
+
+class ArrayRetrieval(abc.ABC):
+    """
+    Base class for the vectorised scorers. A query is scored as a sparse
+    product of its term counts with a precomputed matrix of per-posting
+    weights, plus an optional dense per-document term. As with TfIdfRetrieval,
+    only documents that contain at least one query term are returned.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.arrays = index.arrays()
+        self.version = index.version
+        self.weights = self.arrays.with_weights(self.posting_weights())
+        self.matches = self.arrays.with_weights(np.ones_like(self.arrays.tf.data))
+
+    @abc.abstractmethod
+    def posting_weights(self):
+        """
+        The weight of every posting, aligned with the data of the tf matrix
+        """
+
+    def query_weights(self, queries_repr):
+        return self.arrays.query_matrix(queries_repr)
+
+    def document_scores(self, query_counts):
+        """
+        Dense per-document part of the score for a (1 x terms) query row, None if there is none
+        """
+        return None
+
+    def search(self, query, k=None):
+        return self.search_tokens(read_ap.process_text(query), k)
+
+    def search_tokens(self, query_repr, k=None):
+        return self.search_batch_tokens([query_repr], k)[0]
+
+    def search_batch(self, queries, k=None):
+        return self.search_batch_tokens([read_ap.process_text(query) for query in queries], k)
+
+    def search_batch_tokens(self, queries_repr, k=None, batch_size=32):
+        results = []
+        # the scores are dense (queries x documents), so score a limited number of queries at once
+        for start in range(0, len(queries_repr), batch_size):
+            batch = queries_repr[start:start + batch_size]
+            query_counts = self.query_weights(batch)
+            scores = (query_counts @ self.weights).toarray()
+            matched = (query_counts @ self.matches).tocsr()
+
+            for row in range(len(batch)):
+                candidates = matched.indices[matched.indptr[row]:matched.indptr[row + 1]]
+                q_scores = scores[row, candidates]
+                extra = self.document_scores(query_counts[row])
+                if extra is not None:
+                    q_scores = q_scores + extra[candidates]
+                results.append(top_k(self.arrays.doc_ids, candidates, q_scores, k))
         return results
 
 
+class BM25Retrieval(ArrayRetrieval):
+    """
+    Okapi BM25, with the parameters of bm25_search in assignment 1
+    """
+
+    def __init__(self, index, k1=1.2, k2=100., b=0.75):
+        self.k1 = k1
+        self.k2 = k2
+        self.b = b
+        super().__init__(index)
+
+    def posting_weights(self):
+        a = self.arrays
+        idf = np.log((a.num_docs() - a.df + .5) / (a.df + .5))
+        docs = a.tf.indices
+        tf = a.tf.data
+        K = self.k1 * ((1 - self.b) + self.b * a.doc_lengths[docs] / np.mean(a.doc_lengths))
+        return idf[a.posting_terms] * (self.k1 + 1) * tf / (K + tf)
+
+    def query_weights(self, queries_repr):
+        # saturate the query term frequency: (k2 + 1) qf / (k2 + qf) instead of qf
+        query_counts = super().query_weights(queries_repr)
+        query_counts.data = (self.k2 + 1) * query_counts.data / (self.k2 + query_counts.data)
+        return query_counts
+
+
+class QueryLikelihoodRetrieval(ArrayRetrieval):
+    """
+    Query likelihood with Dirichlet ("dirichlet", parameter mu) or
+    Jelinek-Mercer ("jm", parameter lamb) smoothing, scored in log space
+    """
+
+    def __init__(self, index, smoothing="dirichlet", mu=2000., lamb=.1):
+        assert smoothing in {"dirichlet", "jm"}, "smoothing must be either 'dirichlet' or 'jm'"
+        self.smoothing = smoothing
+        self.mu = mu
+        self.lamb = lamb
+        super().__init__(index)
+        if smoothing == "dirichlet":
+            self.log_background = np.log(self.mu * self.arrays.collection_prob)
+            self.log_norm = np.log(self.arrays.doc_lengths + self.mu)
+        else:
+            self.log_background = np.log(self.lamb * self.arrays.collection_prob)
+
+    def posting_weights(self):
+        # log p(t|d) = log(background) + log(1 + tf / background), the last
+        # term is zero for documents that do not contain t
+        a = self.arrays
+        p_c = a.collection_prob[a.posting_terms]
+        if self.smoothing == "dirichlet":
+            return np.log1p(a.tf.data / (self.mu * p_c))
+        doc_lengths = a.doc_lengths[a.tf.indices]
+        return np.log1p((1 - self.lamb) * a.tf.data / (self.lamb * p_c * doc_lengths))
+
+    def document_scores(self, query_counts):
+        background = query_counts @ self.log_background
+        if self.smoothing == "dirichlet":
+            return background - query_counts.sum() * self.log_norm
+        return np.full(self.arrays.num_docs(), background[0])
+
+
 if __name__ == "__main__":
 
     # ensure dataset is downloaded
@@ -83,16 +343,15 @@ if __name__ == "__main__":
     # Create instance for retrieval
     tfidf_search = TfIdfRetrieval(docs_by_id)
     # read in the qrels
-    qrels, queries = read_ap.read_qrels()
+    qrels_index = load_qrels()
+    qrels, queries = qrels_index.as_dicts()
 
     overall_ser = {}
 
     print("Running TFIDF Benchmark")
-    # collect results
+    # collect results, the queries are already pre-processed in the qrels index
     for qid in tqdm(qrels): 
-        query_text = queries[qid]
-
-        results = tfidf_search.search(query_text)
+        results = tfidf_search.search_tokens(qrels_index.query_tokens(qid))
         overall_ser[qid] = dict(results)
     
     # run evaluation with `qrels` as the ground truth relevance judgements
@@ -104,4 +363,15 @@ if __name__ == "__main__":
     # dump this to JSON
     # *Not* Optional - This is submitted in the assignment!
     with open("tf-idf.json", "w") as writer:
-        json.dump(metrics, writer, indent=1)
\ No newline at end of file
+        json.dump(metrics, writer, indent=1)
+
+    # BM25 and query likelihood are scored on the same index, all queries in one batch
+    qids = list(qrels)
+    queries_repr = [qrels_index.query_tokens(qid) for qid in qids]
+    for name, model in [("bm25", BM25Retrieval(tfidf_search)),
+                        ("ql", QueryLikelihoodRetrieval(tfidf_search))]:
+        print(f"Running {name} Benchmark")
+        results = model.search_batch_tokens(queries_repr)
+        overall_ser = {qid: dict(result) for qid, result in zip(qids, results)}
+        with open(f"{name}.json", "w") as writer:
+            json.dump(evaluator.evaluate(overall_ser), writer, indent=1)
\ No newline at end of file
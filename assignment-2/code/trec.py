@@ -3,20 +3,212 @@ import json
 import subprocess
 import collections
 
+import numpy as np
+
+
+def read_trec_qrels(file_name):
+    """
+    Read a TREC qrels file into a dict of dicts
+    :param file_name: The qrels file, lines of `qid iter doc_id relevance`
+    """
+    qrels = collections.defaultdict(dict)
+    with open(file_name) as reader:
+        for line in reader:
+            fields = line.split()
+            if len(fields) != 4:
+                continue
+            qid, _, doc_id, relevance = fields
+            qrels[qid][doc_id] = int(relevance)
+    return dict(qrels)
+
+
+def read_trec_run(file_name):
+    """
+    Read a TREC run file into a dict of dicts
+    :param file_name: The run file, lines of `qid Q0 doc_id rank score run_name`
+    """
+    run = collections.defaultdict(dict)
+    with open(file_name) as reader:
+        for line in reader:
+            fields = line.split()
+            if len(fields) != 6:
+                continue
+            qid, _, doc_id, _, score, _ = fields
+            run[qid][doc_id] = float(score)
+    return dict(run)
+
+
+def _parse_metric(metric):
+    """
+    Split a trec_eval metric name such as `ndcg_cut_10` or `P_5` into its
+    measure and cutoff (None if the measure has no cutoff)
+    """
+    for prefix in ("map_cut_", "ndcg_cut_", "P_", "recall_"):
+        if metric.startswith(prefix):
+            return prefix[:-1], int(metric[len(prefix):])
+    return metric, None
+
+
+class InProcessEvaluator:
+    """
+    Evaluates runs in-process with NumPy, mimicking the output of trec_eval
+    for the supported measures (map, map_cut_k, ndcg, ndcg_cut_k, P_k,
+    recall_k, recip_rank, Rprec, num_ret, num_rel and num_rel_ret)
+    """
+
+    def __init__(self, qrels):
+        """
+        Index the relevance judgements once so runs can be evaluated without re-reading them
+        :param qrels: Dict of {qid: {doc_id: relevance}}
+        """
+        self.index = {}
+        for qid, judged in qrels.items():
+            doc_ids = np.array(sorted(judged), dtype=str)
+            relevance = np.array([judged[doc_id] for doc_id in doc_ids], dtype=np.float64)
+            self._add_query(qid, doc_ids, relevance)
+
+    @classmethod
+    def from_file(cls, qrels_file_name):
+        return cls(read_trec_qrels(qrels_file_name))
+
+    @classmethod
+    def from_index(cls, qrels_index):
+        """
+        Build the evaluator straight from a qrels_index.QrelsIndex, whose judged docs are already sorted
+        """
+        evaluator = cls({})
+        for qid in qrels_index:
+            doc_ids, relevance = qrels_index.judged_docs(qid)
+            evaluator._add_query(qid, doc_ids, relevance.astype(np.float64))
+        return evaluator
+
+    def _add_query(self, qid, doc_ids, relevance):
+        positive = relevance[relevance > 0]
+        self.index[qid] = {
+            "doc_ids": doc_ids,
+            "relevance": relevance,
+            "num_rel": int(positive.shape[0]),
+            # gains of the ideal ranking, used as the ndcg normaliser
+            "ideal_gains": np.sort(positive)[::-1],
+        }
+
+    def _ranked_relevance(self, qid, ranking):
+        """
+        Order the retrieved documents as trec_eval does (score descending,
+        ties broken by doc_id descending) and look up their relevance
+        """
+        doc_ids = np.array(list(ranking.keys()), dtype=str)
+        scores = np.fromiter(ranking.values(), dtype=np.float64, count=len(ranking))
+        order = np.lexsort((doc_ids, scores))[::-1]
+        doc_ids = doc_ids[order]
+
+        judged = self.index[qid]
+        if judged["doc_ids"].shape[0] == 0:
+            return np.zeros(doc_ids.shape[0])
+        pos = np.searchsorted(judged["doc_ids"], doc_ids)
+        pos = np.minimum(pos, judged["doc_ids"].shape[0] - 1)
+        found = judged["doc_ids"][pos] == doc_ids
+        return np.where(found, judged["relevance"][pos], 0.)
+
+    @staticmethod
+    def _dcg(gains, cutoff=None):
+        if cutoff is not None:
+            gains = gains[:cutoff]
+        return np.sum(gains / np.log2(np.arange(2, gains.shape[0] + 2)))
+
+    def _measure(self, measure, cutoff, gains, num_rel, ideal_gains):
+        num_ret = gains.shape[0]
+        is_rel = gains > 0
+        rel_ret = np.cumsum(is_rel)
+        if measure == "num_ret":
+            return float(num_ret)
+        if measure == "num_rel":
+            return float(num_rel)
+        if measure == "num_rel_ret":
+            return float(rel_ret[-1]) if num_ret else 0.
+        if num_rel == 0:
+            return 0.
+        if measure in ("map", "map_cut"):
+            ranks = np.arange(1, num_ret + 1)
+            precisions = rel_ret / ranks
+            if cutoff is not None:
+                precisions, is_rel = precisions[:cutoff], is_rel[:cutoff]
+            return float(np.sum(precisions[is_rel]) / num_rel)
+        if measure in ("ndcg", "ndcg_cut"):
+            ideal = self._dcg(ideal_gains, cutoff)
+            return float(self._dcg(gains, cutoff) / ideal) if ideal > 0 else 0.
+        if measure == "P":
+            return float(np.sum(is_rel[:cutoff]) / cutoff)
+        if measure == "recall":
+            return float(np.sum(is_rel[:cutoff]) / num_rel)
+        if measure == "recip_rank":
+            first = np.flatnonzero(is_rel)
+            return float(1. / (first[0] + 1)) if first.shape[0] else 0.
+        if measure == "Rprec":
+            return float(np.sum(is_rel[:num_rel]) / num_rel)
+        raise ValueError("Unsupported metric: {}".format(measure))
+
+    def evaluate(self, run, metrics_to_capture, granular=True):
+        """
+        Evaluate a single run
+        :param run: Dict of {qid: {doc_id: score}}
+        :param metrics_to_capture: Which trec_eval metrics to compute
+        :param granular: If True, metrics are returned for all queries (plus "all"), otherwise only the mean
+        """
+        parsed = {metric: _parse_metric(metric) for metric in metrics_to_capture}
+        data = collections.defaultdict(dict)
+        for qid, ranking in run.items():
+            # like trec_eval, queries without judgements are ignored
+            if qid not in self.index or len(ranking) == 0:
+                continue
+            judged = self.index[qid]
+            gains = self._ranked_relevance(qid, ranking)
+            for metric, (measure, cutoff) in parsed.items():
+                data[qid][metric] = self._measure(measure, cutoff, gains,
+                                                  judged["num_rel"], judged["ideal_gains"])
+        evaluated = list(data.keys())
+        for metric in metrics_to_capture:
+            values = [data[qid][metric] for qid in evaluated]
+            # trec_eval sums the counts over queries and averages everything else
+            aggregate = np.sum if metric.startswith("num_") else np.mean
+            data["all"][metric] = float(aggregate(values)) if values else 0.
+        if not granular:
+            return data["all"]
+        return data
+
+    def evaluate_many(self, runs, metrics_to_capture, granular=True):
+        """
+        Evaluate several runs against the same judgements in one call
+        :param runs: Dict of {run_name: {qid: {doc_id: score}}}
+        """
+        return {name: self.evaluate(run, metrics_to_capture, granular) for name, run in runs.items()}
+
 
 class TrecAPI:
     """
     API for TRECEval
     """
 
-    def __init__(self, trec_path):
+    def __init__(self, trec_path=None, backend="binary"):
         """
         Create an instance for the TREC api
-        :param trec_path: The path to the trec binary
+        :param trec_path: The path to the trec binary, only needed for the "binary" backend
+        :param backend: "binary" to run the trec_eval executable, "numpy" to evaluate in-process
         """
-        assert os.path.exists(
-            trec_path), "TREC binary doesn't exist at specified path"
-        self.trec_path = os.path.abspath(trec_path)
+        assert backend in {"binary", "numpy"}, "backend must be either 'binary' or 'numpy'"
+        self.backend = backend
+        if backend == "binary":
+            assert trec_path is not None and os.path.exists(
+                trec_path), "TREC binary doesn't exist at specified path"
+            self.trec_path = os.path.abspath(trec_path)
+        # in-process evaluators, keyed on the qrels file they were built from
+        self._evaluators = {}
+
+    def _get_evaluator(self, test_file_name):
+        key = os.path.abspath(test_file_name)
+        if key not in self._evaluators:
+            self._evaluators[key] = InProcessEvaluator.from_file(test_file_name)
+        return self._evaluators[key]
 
     def evaluate(self, test_file_name, prediction_file_name, metrics_to_capture=None, granular=True):
         """
@@ -30,6 +222,9 @@ class TrecAPI:
         if metrics_to_capture is None:
             metrics_to_capture = {"ndcg_cut_10",
                                   "map_cut_1000", "P_5", "recall_1000"}
+        if self.backend == "numpy":
+            evaluator = self._get_evaluator(test_file_name)
+            return evaluator.evaluate(read_trec_run(prediction_file_name), metrics_to_capture, granular)
         # put this into a try catch block since trec can fail
         try:
             command = [self.trec_path, "-m", "all_trec",
@@ -58,3 +253,23 @@ class TrecAPI:
             # just print out the error if something doesn't work
             print(e.output)
             return None
+
+    def evaluate_runs(self, test_file_name, runs, metrics_to_capture=None, granular=True):
+        """
+        Evaluate many runs against the same test file. Runs can be given as
+        file names or as {qid: {doc_id: score}} dicts; with the "numpy"
+        backend the qrels are only read once and nothing is written to disk
+        :param runs: Dict of {run_name: run file name or run dict}
+        """
+        if metrics_to_capture is None:
+            metrics_to_capture = {"ndcg_cut_10",
+                                  "map_cut_1000", "P_5", "recall_1000"}
+        if self.backend == "numpy":
+            runs = {name: read_trec_run(run) if isinstance(run, str) else run
+                    for name, run in runs.items()}
+            return self._get_evaluator(test_file_name).evaluate_many(runs, metrics_to_capture, granular)
+        results = {}
+        for name, run in runs.items():
+            assert isinstance(run, str), "The binary backend can only evaluate run files"
+            results[name] = self.evaluate(test_file_name, run, metrics_to_capture, granular)
+        return results
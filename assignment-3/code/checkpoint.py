@@ -0,0 +1,188 @@
+"""
+Checkpoints for resumable training.
+
+A checkpoint holds everything needed to continue a run where it stopped:
+the model, the optimizer, the random number generators, the position of the
+data loader in its epoch, the ValidationMonitor and whatever the trainer
+puts in `extra` (its epoch, counters and result lists). Files are written
+to a temporary file and moved into place, so a crash while saving never
+leaves a broken checkpoint behind.
+
+The best model by validation metric is kept separately in best.pt, written
+when it improves, so it is a snapshot of the weights at that moment.
+"""
+import os
+import re
+import random
+
+import numpy as np
+import torch
+
+CHECKPOINT_VERSION = 1
+
+_CHECKPOINT_RE = re.compile(r'^checkpoint_(\d+)\.pt$')
+
+
+def load_file(path, map_location='cpu'):
+    """
+    torch.load of a file that can contain more than tensors, e.g. NumPy arrays or a pickled module.
+    """
+    try:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    except TypeError:
+        # weights_only is only known from torch 1.13 on
+        return torch.load(path, map_location=map_location)
+
+
+def save_file(obj, path):
+    """
+    torch.save to a temporary file that replaces path once it is completely on disk.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer(object):
+    """
+    Writes and restores the checkpoints of one training run in a directory.
+
+    Args:
+        directory (str): Where the checkpoints of the run are kept.
+        keep (int): Number of most recent checkpoints kept on disk, older ones are removed.
+    """
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def checkpoints(self):
+        """
+        The paths of the checkpoints on disk, oldest first.
+        """
+        numbered = []
+        for name in os.listdir(self.directory):
+            match = _CHECKPOINT_RE.match(name)
+            if match is not None:
+                numbered.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return [path for _, path in sorted(numbered)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, step, model, optimizer=None, loader=None, monitor=None, extra=None):
+        """
+        Writes a checkpoint of the current state of training, step is only stored.
+        """
+        checkpoints = self.checkpoints()
+        number = int(_CHECKPOINT_RE.match(os.path.basename(checkpoints[-1])).group(1)) + 1 if checkpoints else 0
+        state = {
+            'format_version': CHECKPOINT_VERSION,
+            'step': step,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict() if optimizer is not None else None,
+            'loader': loader.state_dict() if loader is not None else None,
+            'monitor': monitor.state_dict() if monitor is not None else None,
+            'rng': rng_state(),
+            'extra': extra,
+        }
+        path = os.path.join(self.directory, 'checkpoint_%06d.pt' % number)
+        save_file(state, path)
+        for old_path in (checkpoints + [path])[:-self.keep]:
+            os.remove(old_path)
+        return path
+
+    def resume(self, model, optimizer=None, loader=None, monitor=None):
+        """
+        Restores the latest checkpoint, if there is one.
+
+        Returns:
+            dict: The checkpoint, with the 'step' and 'extra' of the trainer,
+                  None if there is no checkpoint to resume from.
+        """
+        path = self.latest()
+        if path is None:
+            return None
+        state = load_file(path)
+        if state.get('format_version') != CHECKPOINT_VERSION:
+            raise ValueError('Checkpoint %s has format version %s, expected %d' % (
+                path, state.get('format_version'), CHECKPOINT_VERSION))
+        model.load_state_dict(state['model'])
+        if optimizer is not None and state['optimizer'] is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if loader is not None and state['loader'] is not None:
+            loader.load_state_dict(state['loader'])
+        if monitor is not None and state['monitor'] is not None:
+            monitor.load_state_dict(state['monitor'])
+        set_rng_state(state['rng'])
+        print('Resumed from {} at step {}'.format(path, state['step']))
+        return state
+
+    def save_evaluation(self, step, model, optimizer=None, loader=None, monitor=None, extra=None):
+        """
+        Writes a checkpoint after an evaluation by monitor, and the best model if the evaluation improved it.
+        """
+        if monitor is not None and monitor.improved:
+            self.save_best(monitor.best_state, monitor.best_value, step)
+        return self.save(step, model, optimizer, loader, monitor, extra)
+
+    @property
+    def best_path(self):
+        return os.path.join(self.directory, 'best.pt')
+
+    def save_best(self, state_dict, value, step):
+        """
+        Writes the best model so far, state_dict can be a model or its state_dict.
+        """
+        if isinstance(state_dict, torch.nn.Module):
+            state_dict = state_dict.state_dict()
+        save_file({'format_version': CHECKPOINT_VERSION, 'model': state_dict, 'value': value, 'step': step},
+                  self.best_path)
+
+    def load_best(self, model):
+        """
+        Loads the best model into model and returns its validation value, None if there is no best model.
+        """
+        if not os.path.exists(self.best_path):
+            return None
+        state = load_file(self.best_path)
+        model.load_state_dict(state['model'])
+        return state['value']
+
+
+def resume_run(checkpoint_dir, model, optimizer=None, loader=None, monitor=None):
+    """
+    Sets up checkpointing of a training run and restores its latest checkpoint.
+
+    Returns:
+        Checkpointer: The Checkpointer of checkpoint_dir, None if checkpoint_dir is None.
+        dict: The checkpoint that was restored (see Checkpointer.resume), None if training starts from scratch.
+    """
+    if not checkpoint_dir:
+        return None, None
+    checkpointer = Checkpointer(checkpoint_dir)
+    return checkpointer, checkpointer.resume(model, optimizer, loader, monitor)
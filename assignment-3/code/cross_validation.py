@@ -0,0 +1,165 @@
+"""
+Trains and evaluates a model on every fold of the dataset, with every fold
+in its own process, and aggregates the results over the folds.
+"""
+import os
+import time
+import pickle
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+import dataset
+from rank_net import Rank_Net, Rank_Net_Sped_Up
+from lambda_rank import LambdaRank
+from monitor import ValidationMonitor
+
+MODELS = ['rank_net', 'rank_net_sped_up', 'lambda_rank']
+
+DEFAULT_PARAMS = {
+    'lr': 1e-3,
+    'hidden': [200],
+    'sigma': 1.0,
+    'batch_size': 100,
+    'num_epochs': 1,
+    'eval_freq': 1000,
+    # pair selection of LambdaRank, see delta_metrics.truncated_lambdas
+    'top_k': None,
+    'num_samples': None,
+}
+
+
+def train_model(model_name, data, params, name_suffix='', callback=None):
+    """
+    Trains one of MODELS on a read DataFold, callback is passed on to
+    the ValidationMonitor of the trainer.
+
+    Returns:
+        nn.Module: The network that scores the documents, with the weights of
+                   its best validation NDCG as kept for early stopping.
+        list float: The validation NDCG over training.
+    """
+    params = dict(DEFAULT_PARAMS, **params)
+    if model_name in ['rank_net', 'rank_net_sped_up']:
+        model_class = Rank_Net if model_name == 'rank_net' else Rank_Net_Sped_Up
+        net = model_class(data.num_features, params['hidden'], sigma=params['sigma'])
+        net.model_id += name_suffix
+        net.train_bgd(data, lr=params['lr'], batch_size=params['batch_size'],
+                      num_epochs=params['num_epochs'], eval_freq=params['eval_freq'], callback=callback)
+        if net.best_state is not None:
+            net.layers.load_state_dict(net.best_state)
+        return net.layers, net.validation_results
+    elif model_name == 'lambda_rank':
+        model = LambdaRank(params['hidden'], data.num_features, params['lr'], params['sigma'])
+        model.name += name_suffix
+        best_state, _, ndcgs, _ = model.train(data, 'ndcg', params['lr'], params['sigma'],
+                                     num_epochs=params['num_epochs'], batch_size=params['batch_size'],
+                                     callback=callback, top_k=params['top_k'], num_samples=params['num_samples'],
+                                     eval_freq=params['eval_freq'])
+        if best_state is not None:
+            model.model.load_state_dict(best_state)
+        return model.model, ndcgs
+    raise ValueError('Unknown model: %s' % model_name)
+
+
+def limit_threads(num_threads):
+    # every process gets its own share of the cores instead of all of them
+    torch.set_num_threads(num_threads)
+
+
+def run_fold(model_name, params, fold_num, num_folds):
+    start = time.time()
+    data = dataset.get_dataset(num_folds=num_folds).get_data_folds()[fold_num]
+    # only parses the fold the first time, afterwards its memory-mapped cache is used
+    data.read_data()
+    module, ndcgs = train_model(model_name, data, params, name_suffix='_fold%d' % fold_num)
+    device = next(module.parameters()).device
+    return {
+        'fold': fold_num,
+        'validation': ValidationMonitor(data.validation, device=device).evaluate(module),
+        'test': ValidationMonitor(data.test, device=device).evaluate(module),
+        'validation_ndcgs': ndcgs,
+        'time': time.time() - start,
+    }
+
+
+def aggregate(fold_results, split='test'):
+    """
+    The mean and standard deviation over the folds of every metric.
+    """
+    metrics = sorted(set.intersection(*[set(r[split]) for r in fold_results]))
+    return {k: (np.mean([r[split][k][0] for r in fold_results]),
+                np.std([r[split][k][0] for r in fold_results]))
+            for k in metrics}
+
+
+def run_folds(model_name, params=None, num_folds=5, num_workers=None, threads_per_worker=None):
+    """
+    Trains and evaluates the model on all folds, every fold in its own process.
+
+    Returns:
+        list dict: The results of every fold.
+        dict: The test results aggregated over the folds.
+    """
+    if params is None:
+        params = {}
+    if num_workers is None:
+        num_workers = num_folds
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+    # torch does not like to be forked after it started its thread pools
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(num_workers, mp_context=context, initializer=limit_threads,
+                             initargs=(threads_per_worker,)) as executor:
+        futures = [executor.submit(run_fold, model_name, params, fold_num, num_folds)
+                   for fold_num in range(num_folds)]
+        fold_results = [future.result() for future in futures]
+    return fold_results, aggregate(fold_results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=MODELS, default='rank_net_sped_up')
+    parser.add_argument('--num_folds', type=int, default=5)
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of folds trained at the same time, all of them by default')
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    parser.add_argument('--learning_rate', type=float, default=DEFAULT_PARAMS['lr'])
+    parser.add_argument('--n_hiddens', type=str, default='200',
+                        help='Comma separated list of number of units in each hidden layer')
+    parser.add_argument('--sigma', type=float, default=DEFAULT_PARAMS['sigma'])
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_PARAMS['batch_size'])
+    parser.add_argument('--num_epochs', type=int, default=DEFAULT_PARAMS['num_epochs'])
+    parser.add_argument('--eval_freq', type=int, default=DEFAULT_PARAMS['eval_freq'])
+    parser.add_argument('--top_k', type=int, default=None,
+                        help='LambdaRank only uses the pairs with a document in the current top k')
+    parser.add_argument('--num_samples', type=int, default=None,
+                        help='Number of sampled pairs per top k document of LambdaRank')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    params = {
+        'lr': FLAGS.learning_rate,
+        'hidden': [int(n) for n in FLAGS.n_hiddens.split(',')],
+        'sigma': FLAGS.sigma,
+        'batch_size': FLAGS.batch_size,
+        'num_epochs': FLAGS.num_epochs,
+        'eval_freq': FLAGS.eval_freq,
+        'top_k': FLAGS.top_k,
+        'num_samples': FLAGS.num_samples,
+    }
+    start = time.time()
+    fold_results, test_results = run_folds(FLAGS.model, params, FLAGS.num_folds, FLAGS.num_workers,
+                                           FLAGS.threads_per_worker)
+    for r in fold_results:
+        print('Fold %d: test NDCG %0.04f, validation NDCG %0.04f, %0.1f seconds' % (
+            r['fold'], r['test']['ndcg'][0], r['validation']['ndcg'][0], r['time']))
+    print('"metric": "mean over folds" ("standard deviation over folds")')
+    for k, (mean_v, std_v) in test_results.items():
+        print('%s: %0.04f (%0.05f)' % (k, mean_v, std_v))
+    print('Finished %d folds in %0.1f seconds' % (FLAGS.num_folds, time.time() - start))
+    with open('cv_results_' + FLAGS.model + '.pkl', 'wb') as f:
+        pickle.dump({'params': params, 'folds': fold_results, 'test': test_results}, f)
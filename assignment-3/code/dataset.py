@@ -1,8 +1,14 @@
 import os
+import re
 import gc
 import json
 import os.path
+import queue
 import zipfile
+import functools
+import weakref
+import threading
+import multiprocessing
 
 import requests
 import numpy as np
@@ -11,20 +17,132 @@ from tqdm import tqdm
 import torch
 
 
-FOLDDATA_WRITE_VERSION = 4
+FOLDDATA_WRITE_VERSION = 7
+
+# letor files are parsed in pieces of about this many bytes
+READ_CHUNK_SIZE = 32 * 1024 * 1024
+# features are normalized in groups of whole queries of about this many documents
+NORMALIZE_CHUNK_DOCS = 64 * 1024
+# cutoffs of the ideal DCG stored per query, 0 means no cutoff
+IDEAL_DCG_CUTOFFS = (0, 3, 5, 10, 20)
+# labels above this value count as relevant for precision and recall
+RELEVANT_LABEL = 2
+
+_COMMENT_RE = re.compile(rb'#[^\n]*')
 
 
 def _add_zero_to_vector(vector):
     return np.concatenate([np.zeros(1, dtype=vector.dtype), vector])
 
 
+def _query_label_stats(doclist_ranges, label_vector):
+    """
+    Computes per query the ideal DCG at IDEAL_DCG_CUTOFFS, the maximum label
+    and the number of relevant documents, for all queries at once.
+    """
+    sizes = doclist_ranges[1:] - doclist_ranges[:-1]
+    starts = doclist_ranges[:-1]
+    doc_query = np.repeat(np.arange(sizes.shape[0]), sizes)
+    rank = np.arange(label_vector.shape[0]) - np.repeat(starts, sizes)
+
+    ideal_labels = label_vector[np.lexsort((-label_vector, doc_query))]
+    gains = (2 ** ideal_labels - 1.) / np.log2(rank + 2.)
+    ideal_dcg = np.zeros((sizes.shape[0], len(IDEAL_DCG_CUTOFFS)))
+    max_label = np.zeros(sizes.shape[0], dtype=label_vector.dtype)
+    num_relevant = np.zeros(sizes.shape[0], dtype=np.int64)
+    if label_vector.shape[0] > 0:
+        for i, k in enumerate(IDEAL_DCG_CUTOFFS):
+            in_top = rank < k if k > 0 else np.ones(rank.shape[0], dtype=bool)
+            ideal_dcg[:, i] = np.add.reduceat(gains * in_top, starts)
+        max_label = np.maximum.reduceat(label_vector, starts)
+        num_relevant = np.add.reduceat(np.greater(label_vector, RELEVANT_LABEL).astype(np.int64), starts)
+    return ideal_dcg, max_label, num_relevant
+
+
+def _count_lines(path):
+    """
+    Number of lines in the file, an upper bound on its number of documents since blank lines are skipped.
+    """
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            count += block.count(b'\n')
+            last = block[-1:]
+    return count + (last != b'\n')
+
+
+def _chunk_ranges(path, chunk_size):
+    """
+    Splits a file into byte ranges of about chunk_size that end on a line boundary.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _parse_letor_chunk(args):
+    """
+    Parses the lines in a byte range of a letor file without a python loop over lines:
+    comments are stripped, every ':' becomes a space and the whole range is
+    read as one array of numbers. Every line then holds 2 + 2 * nnz numbers,
+    where nnz is its number of ':' minus the one of 'qid:'. Lines without
+    any ':' are blank (or held only a comment) and are skipped.
+
+    Returns the labels, qids and nnz of every line and the concatenated
+    feature ids and values of all lines.
+    """
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    chunk = _COMMENT_RE.sub(b'', chunk)
+    if not chunk.endswith(b'\n'):
+        chunk += b'\n'
+
+    raw = np.frombuffer(chunk, dtype=np.uint8)
+    line_ends = np.flatnonzero(raw == ord('\n'))
+    colons = np.flatnonzero(raw == ord(':'))
+    nnz = np.diff(_add_zero_to_vector(np.searchsorted(colons, line_ends))) - 1
+    # blank lines have no numbers at all, so they are simply dropped from the lines
+    nnz = nnz[nnz >= 0]
+    del raw, colons
+
+    tokens = np.fromstring(chunk.replace(b'qid:', b' ').replace(b':', b' '), sep=' ')
+    line_tokens = 2 + 2 * nnz
+    assert tokens.shape[0] == np.sum(line_tokens), 'could not parse %s' % path
+    line_starts = np.cumsum(line_tokens) - line_tokens
+
+    labels = tokens[line_starts].astype(np.int64)
+    qids = tokens[line_starts + 1].astype(np.int64)
+    pair_starts = np.cumsum(nnz) - nnz
+    pair_pos = np.repeat(line_starts + 2, nnz) + 2 * (np.arange(np.sum(nnz)) - np.repeat(pair_starts, nnz))
+    feat_ids = tokens[pair_pos].astype(np.int64)
+    feat_values = tokens[pair_pos + 1]
+    return labels, qids, nnz, feat_ids, feat_values
+
+
 def get_dataset(num_folds=1,
                 num_relevance_labels=5,
                 num_nonzero_feat=519,
                 num_unique_feat=501,
-                query_normalized=False):
-
-    fold_paths = ["./dataset"]
+                query_normalized=False,
+                num_read_workers=1,
+                feature_dtype='float32'):
+
+    if num_folds == 1:
+        fold_paths = ["./dataset"]
+    else:
+        # the standard LETOR layout with one folder per fold
+        fold_paths = ["./dataset/Fold%d/" % (i + 1) for i in range(num_folds)]
     return DataSet(
         "ir1-2020",
         fold_paths,
@@ -32,6 +150,8 @@ def get_dataset(num_folds=1,
         num_unique_feat,
         num_nonzero_feat,
         already_normalized=query_normalized,
+        num_read_workers=num_read_workers,
+        feature_dtype=feature_dtype,
     )
 
 
@@ -51,7 +171,9 @@ class DataSet(object):
                  read_from_pickle=True,
                  feature_normalization=True,
                  purge_test_set=True,
-                 already_normalized=False):
+                 already_normalized=False,
+                 num_read_workers=1,
+                 feature_dtype='float32'):
         self.name = name
         self.num_rel_labels = num_rel_labels
         self.num_features = num_features
@@ -61,6 +183,9 @@ class DataSet(object):
         self.feature_normalization = feature_normalization
         self.purge_test_set = purge_test_set
         self._num_nonzero_feat = num_nonzero_feat
+        self.num_read_workers = num_read_workers
+        # dtype of the cached feature matrices, 'float32' or 'float16'
+        self.feature_dtype = feature_dtype
 
     def num_folds(self):
         return len(self.data_paths)
@@ -70,12 +195,18 @@ class DataSet(object):
 
 
 class DataFoldSplit(object):
-    def __init__(self, datafold, name, doclist_ranges, feature_matrix, label_vector):
+    def __init__(self, datafold, name, doclist_ranges, feature_matrix, label_vector, query_stats=None):
         self.datafold = datafold
         self.name = name
         self.doclist_ranges = doclist_ranges
         self.feature_matrix = feature_matrix
         self.label_vector = label_vector
+        # label statistics per query, computed once instead of on every evaluation
+        if query_stats is None:
+            query_stats = _query_label_stats(doclist_ranges, label_vector)
+        self.ideal_dcg, self.max_label, self.num_relevant = query_stats
+        # queries with at least one document with a positive label
+        self.included_mask = self.max_label > 0
 
     def num_queries(self):
         return self.doclist_ranges.shape[0] - 1
@@ -96,6 +227,12 @@ class DataFoldSplit(object):
     def query_sizes(self):
         return (self.doclist_ranges[1:] - self.doclist_ranges[:-1])
 
+    def query_ideal_dcg(self, query_index, k=0):
+        """
+        The ideal DCG of the query at cutoff k, which is one of IDEAL_DCG_CUTOFFS.
+        """
+        return self.ideal_dcg[query_index, IDEAL_DCG_CUTOFFS.index(k)]
+
     def query_labels(self, query_index):
         s_i = self.doclist_ranges[query_index]
         e_i = self.doclist_ranges[query_index+1]
@@ -137,78 +274,111 @@ class DataFold(object):
         self.feature_normalization = dataset.feature_normalization
         self.purge_test_set = dataset.purge_test_set
         self._num_nonzero_feat = dataset._num_nonzero_feat
+        self.num_read_workers = dataset.num_read_workers
+        self.feature_dtype = dataset.feature_dtype
+        # splits are only loaded from the cache when they are first accessed
+        self._splits = {}
+        self._split_loaders = {}
+
+    @property
+    def train(self):
+        return self._get_split('train')
+
+    @property
+    def validation(self):
+        return self._get_split('validation')
+
+    @property
+    def test(self):
+        return self._get_split('test')
+
+    def _get_split(self, name):
+        if name not in self._splits:
+            assert name in self._split_loaders, 'read_data has to be called before accessing the data'
+            self._splits[name] = self._split_loaders.pop(name)()
+        return self._splits[name]
 
     def data_ready(self):
         return self._data_ready
 
     def clean_data(self):
-        del self.train
-        del self.validation
-        del self.test
+        self._splits = {}
+        self._split_loaders = {}
         self._data_ready = False
         gc.collect()
 
     def _read_file(self, path, feat_map, purge):
         '''
         Read letor file.
+
+        The lines of the file are counted first so the float32 feature matrix
+        can be allocated once, then it is parsed in chunks (in parallel if
+        num_read_workers > 1) that are written directly into the matrix,
+        which is cut to the documents read if the file has blank lines.
         '''
-        queries = []
-        cur_docs = []
-        cur_labels = []
-        current_qid = None
-
-        for line in open(path, 'r'):
-            info = line[:line.find('#')].split()
-            qid = info[1].split(':')[1]
-            label = int(info[0])
-            feat_pairs = info[2:]
-
-            if current_qid is None:
-                current_qid = qid
-            elif current_qid != qid:
-                stacked_documents = np.stack(cur_docs, axis=0)
-                if self.feature_normalization:
-                    stacked_documents -= np.amin(stacked_documents,
-                                                 axis=0)[None, :]
-                    safe_max = np.amax(stacked_documents, axis=0)
-                    safe_max[safe_max == 0] = 1.
-                    stacked_documents /= safe_max[None, :]
-
-                np_labels = np.array(cur_labels, dtype=np.int64)
-                if not purge or np.any(np.greater(np_labels, 0)):
-                    queries.append(
-                        {
-                            'qid': current_qid,
-                            'n_docs': stacked_documents.shape[0],
-                            'labels': np_labels,
-                            'documents': stacked_documents
-                        }
-                    )
-                current_qid = qid
-                cur_docs = []
-                cur_labels = []
-
-            doc_feat = np.zeros(self._num_nonzero_feat)
-            for pair in feat_pairs:
-                feat_id, feature = pair.split(':')
+        num_docs = _count_lines(path)
+        feature_matrix = np.zeros((num_docs, self._num_nonzero_feat), dtype=np.float32)
+        label_vector = np.zeros(num_docs, dtype=np.int64)
+        qid_vector = np.zeros(num_docs, dtype=np.int64)
+
+        chunk_size = READ_CHUNK_SIZE
+        if self.num_read_workers > 1:
+            chunk_size = min(chunk_size, int(np.ceil(os.path.getsize(path) / self.num_read_workers)))
+        ranges = [(path, s_i, e_i) for s_i, e_i in _chunk_ranges(path, chunk_size)]
+
+        if self.num_read_workers > 1 and len(ranges) > 1:
+            pool = multiprocessing.Pool(min(self.num_read_workers, len(ranges)))
+            parsed_chunks = pool.imap(_parse_letor_chunk, ranges)
+        else:
+            pool = None
+            parsed_chunks = map(_parse_letor_chunk, ranges)
+
+        n_read = 0
+        # chunks come in file order, so features are still mapped in order of first appearance
+        for labels, qids, nnz, feat_ids, feat_values in parsed_chunks:
+            # feature ids are small integers, so index by id instead of sorting
+            first_i = np.full(np.amax(feat_ids, initial=0) + 1, feat_ids.shape[0])
+            np.minimum.at(first_i, feat_ids, np.arange(feat_ids.shape[0]))
+            unique_ids = np.flatnonzero(first_i < feat_ids.shape[0])
+            for feat_id in unique_ids[np.argsort(first_i[unique_ids])]:
                 feat_id = int(feat_id)
-                feat_value = float(feature)
                 if feat_id not in feat_map:
                     feat_map[feat_id] = len(feat_map)
                     assert feat_map[feat_id] < self._num_nonzero_feat, '%s features found but %s expected' % (
                         feat_map[feat_id], self._num_nonzero_feat)
-                doc_feat[feat_map[feat_id]] = feat_value
-
-            cur_docs.append(doc_feat)
-            cur_labels.append(label)
-
-        all_docs = np.concatenate([x['documents'] for x in queries], axis=0)
-        all_n_docs = np.array([x['n_docs'] for x in queries], dtype=np.int64)
-        all_labels = np.concatenate([x['labels'] for x in queries], axis=0)
-
-        query_ranges = _add_zero_to_vector(np.cumsum(all_n_docs))
-
-        return query_ranges, all_docs, all_labels
+            columns = np.zeros(first_i.shape[0], dtype=np.int64)
+            columns[unique_ids] = [feat_map[int(feat_id)] for feat_id in unique_ids]
+
+            n_lines = labels.shape[0]
+            rows = np.repeat(np.arange(n_read, n_read + n_lines), nnz)
+            feature_matrix[rows, columns[feat_ids]] = feat_values
+            label_vector[n_read:n_read + n_lines] = labels
+            qid_vector[n_read:n_read + n_lines] = qids
+            n_read += n_lines
+        if pool is not None:
+            pool.close()
+            pool.join()
+        assert n_read <= num_docs, '%d documents read but %d lines counted' % (n_read, num_docs)
+        if n_read < num_docs:
+            feature_matrix = feature_matrix[:n_read]
+            label_vector = label_vector[:n_read]
+            qid_vector = qid_vector[:n_read]
+            num_docs = n_read
+
+        # a new query starts wherever the qid changes
+        query_starts = np.flatnonzero(qid_vector[1:] != qid_vector[:-1]) + 1
+        query_ranges = np.concatenate([[0], query_starts, [num_docs]]).astype(np.int64)
+
+        if purge:
+            n_docs = np.diff(query_ranges)
+            keep_query = np.maximum.reduceat(label_vector, query_ranges[:-1]) > 0
+            if not np.all(keep_query):
+                keep_doc = np.repeat(keep_query, n_docs)
+                feature_matrix = feature_matrix[keep_doc]
+                label_vector = label_vector[keep_doc]
+                query_ranges = _add_zero_to_vector(np.cumsum(n_docs[keep_query]))
+
+        return query_ranges, feature_matrix, label_vector
 
     def _create_feature_mapping(self, feature_dict):
         total_features = 0
@@ -219,55 +389,107 @@ class DataFold(object):
                 total_features += 1
         return feature_map
 
-    def _normalize_feat(self, query_ranges, feature_matrix):
+    def _normalize_feat(self, query_ranges, feature_matrix, chunk_docs=NORMALIZE_CHUNK_DOCS):
+        """
+        Min-max normalizes the features of every query in place and returns
+        which features vary within at least one query.
+
+        The per-query minima and maxima come from reduceat over the query
+        ranges. Queries are processed in groups of about chunk_docs documents,
+        which bounds the temporary memory.
+        """
         non_zero_feat = np.zeros(feature_matrix.shape[1], dtype=bool)
-        for qid in range(query_ranges.shape[0]-1):
-            s_i, e_i = query_ranges[qid:qid+2]
+        # split the queries into groups at the first query past every chunk_docs documents
+        boundaries = np.searchsorted(query_ranges[:-1],
+                                     np.arange(0, query_ranges[-1], chunk_docs),
+                                     side='left')
+        boundaries = np.unique(np.append(boundaries, query_ranges.shape[0] - 1))
+        for q_s, q_e in zip(boundaries[:-1], boundaries[1:]):
+            s_i, e_i = query_ranges[q_s], query_ranges[q_e]
             cur_feat = feature_matrix[s_i:e_i, :]
-            min_q = np.amin(cur_feat, axis=0)
-            max_q = np.amax(cur_feat, axis=0)
-            cur_feat -= min_q[None, :]
+            starts = query_ranges[q_s:q_e] - s_i
+            min_q = np.minimum.reduceat(cur_feat, starts, axis=0)
+            max_q = np.maximum.reduceat(cur_feat, starts, axis=0)
             denom = max_q - min_q
+            non_zero_feat |= np.any(denom > 0., axis=0)
             denom[denom == 0.] = 1.
-            cur_feat /= denom[None, :]
-            non_zero_feat += np.greater(max_q, min_q)
+            # the query of every document in the group
+            doc_query = np.repeat(np.arange(q_e - q_s), np.diff(query_ranges[q_s:q_e + 1]))
+            cur_feat -= min_q[doc_query]
+            cur_feat /= denom[doc_query]
         return non_zero_feat
 
+    def _load_split(self, cache_path, name):
+        return DataFoldSplit(self,
+                             name,
+                             np.load(os.path.join(cache_path, name + '_doclist_ranges.npy')),
+                             np.load(os.path.join(cache_path, name + '_feature_matrix.npy'), mmap_mode='r'),
+                             np.load(os.path.join(cache_path, name + '_label_vector.npy')),
+                             (np.load(os.path.join(cache_path, name + '_ideal_dcg.npy')),
+                              np.load(os.path.join(cache_path, name + '_max_label.npy')),
+                              np.load(os.path.join(cache_path, name + '_num_relevant.npy'))))
+
+    def _store_cache(self, cache_path, feature_map, splits):
+        """
+        Stores every split as raw .npy files, the manifest is written last
+        so that an interrupted write is never mistaken for a complete cache.
+        """
+        os.makedirs(cache_path, exist_ok=True)
+        manifest = {
+            'format_version': FOLDDATA_WRITE_VERSION,
+            'dtype': self.feature_dtype,
+            # feature ids in the order of the columns
+            'feature_ids': [x[0] for x in sorted(feature_map.items(), key=lambda x: x[1])],
+            'splits': {},
+        }
+        for name, split in splits.items():
+            for array_name in ['doclist_ranges', 'feature_matrix', 'label_vector',
+                               'ideal_dcg', 'max_label', 'num_relevant']:
+                path = os.path.join(cache_path, '%s_%s.npy' % (name, array_name))
+                np.save(path + '.tmp.npy', getattr(split, array_name))
+                os.replace(path + '.tmp.npy', path)
+            manifest['splits'][name] = {'num_queries': int(split.num_queries()),
+                                        'num_docs': int(split.num_docs())}
+        manifest_path = os.path.join(cache_path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
     def read_data(self):
         """
         Reads data from a fold folder (letor format).
+
+        After the first read every split is cached as uncompressed .npy files,
+        later reads memory-map the feature matrices and only open a split
+        when it is accessed.
         """
         data_read = False
         if self.feature_normalization and self.purge_test_set:
-            pickle_name = 'binarized_purged_querynorm.npz'
+            cache_name = 'binarized_purged_querynorm'
         elif self.feature_normalization:
-            pickle_name = 'binarized_querynorm.npz'
+            cache_name = 'binarized_querynorm'
         elif self.purge_test_set:
-            pickle_name = 'binarized_purged.npz'
+            cache_name = 'binarized_purged'
         else:
-            pickle_name = 'binarized.npz'
+            cache_name = 'binarized'
 
-        pickle_path = self.data_path + pickle_name
+        cache_path = self.data_path + cache_name + '_' + self.feature_dtype
+        manifest_path = os.path.join(cache_path, 'manifest.json')
 
         train_raw_path = os.path.join(self.data_path, 'train.txt')
         valid_raw_path = os.path.join(self.data_path, 'vali.txt')
         test_raw_path = os.path.join(self.data_path, 'test.txt')
 
-        if self.read_from_pickle and os.path.isfile(pickle_path):
-            loaded_data = np.load(pickle_path, allow_pickle=True)
-            if loaded_data['format_version'] == FOLDDATA_WRITE_VERSION:
-                feature_map = loaded_data['feature_map'].item()
-                train_feature_matrix = loaded_data['train_feature_matrix']
-                train_doclist_ranges = loaded_data['train_doclist_ranges']
-                train_label_vector = loaded_data['train_label_vector']
-                valid_feature_matrix = loaded_data['valid_feature_matrix']
-                valid_doclist_ranges = loaded_data['valid_doclist_ranges']
-                valid_label_vector = loaded_data['valid_label_vector']
-                test_feature_matrix = loaded_data['test_feature_matrix']
-                test_doclist_ranges = loaded_data['test_doclist_ranges']
-                test_label_vector = loaded_data['test_label_vector']
+        self._splits = {}
+        self._split_loaders = {}
+        if self.read_from_pickle and os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['format_version'] == FOLDDATA_WRITE_VERSION and manifest['dtype'] == self.feature_dtype:
+                feature_map = {fid: i for i, fid in enumerate(manifest['feature_ids'])}
+                for name in ['train', 'validation', 'test']:
+                    self._split_loaders[name] = functools.partial(self._load_split, cache_path, name)
                 data_read = True
-            del loaded_data
 
         if not data_read:
             feature_map = {}
@@ -314,28 +536,34 @@ class DataFold(object):
             sorted_map = sorted(feature_map.items())
             transform_ind = np.array([x[1] for x in sorted_map])
 
-            train_feature_matrix = train_feature_matrix[:, transform_ind]
-            valid_feature_matrix = valid_feature_matrix[:, transform_ind]
-            test_feature_matrix = test_feature_matrix[:, transform_ind]
+            train_feature_matrix = train_feature_matrix[:, transform_ind].astype(self.feature_dtype)
+            valid_feature_matrix = valid_feature_matrix[:, transform_ind].astype(self.feature_dtype)
+            test_feature_matrix = test_feature_matrix[:, transform_ind].astype(self.feature_dtype)
 
             feature_map = {}
             for i, x in enumerate([x[0] for x in sorted_map]):
                 feature_map[x] = i
 
+            self._splits = {
+                'train': DataFoldSplit(self,
+                                       'train',
+                                       train_doclist_ranges,
+                                       train_feature_matrix,
+                                       train_label_vector),
+                'validation': DataFoldSplit(self,
+                                            'validation',
+                                            valid_doclist_ranges,
+                                            valid_feature_matrix,
+                                            valid_label_vector),
+                'test': DataFoldSplit(self,
+                                      'test',
+                                      test_doclist_ranges,
+                                      test_feature_matrix,
+                                      test_label_vector),
+            }
+
             if self.store_pickle_after_read:
-                np.savez_compressed(pickle_path,
-                                    format_version=FOLDDATA_WRITE_VERSION,
-                                    feature_map=feature_map,
-                                    train_feature_matrix=train_feature_matrix,
-                                    train_doclist_ranges=train_doclist_ranges,
-                                    train_label_vector=train_label_vector,
-                                    valid_feature_matrix=valid_feature_matrix,
-                                    valid_doclist_ranges=valid_doclist_ranges,
-                                    valid_label_vector=valid_label_vector,
-                                    test_feature_matrix=test_feature_matrix,
-                                    test_doclist_ranges=test_doclist_ranges,
-                                    test_label_vector=test_label_vector,
-                                    )
+                self._store_cache(cache_path, feature_map, self._splits)
 
         n_feat = len(feature_map)
         assert n_feat == self.num_features, '%d features found but %d expected' % (
@@ -344,21 +572,6 @@ class DataFold(object):
         self.inverse_feature_map = feature_map
         self.feature_map = [x[0] for x in sorted(
             feature_map.items(), key=lambda x: x[1])]
-        self.train = DataFoldSplit(self,
-                                   'train',
-                                   train_doclist_ranges,
-                                   train_feature_matrix,
-                                   train_label_vector)
-        self.validation = DataFoldSplit(self,
-                                        'validation',
-                                        valid_doclist_ranges,
-                                        valid_feature_matrix,
-                                        valid_label_vector)
-        self.test = DataFoldSplit(self,
-                                  'test',
-                                  test_doclist_ranges,
-                                  test_feature_matrix,
-                                  test_label_vector)
         self._data_ready = True
 
 
@@ -386,24 +599,60 @@ def download_dataset():
             zip_ref.extractall(folder_path)
             
 class DataClass(object):
-    def __init__(self, featvecs, labels, shuffle=False):
-        
+    """
+    Samples batches of documents for pointwise training.
+
+    The features are kept in one float32 tensor (pinned if a GPU is available)
+    in their original order; shuffling only permutes an index array and
+    batches are gathered from the tensor when they are requested. With a GPU
+    the batches are gathered into a ring of prefetch + 2 pinned buffers that
+    is reused, so a batch must not be modified and has to be moved to the GPU
+    (or copied) before that many more batches are requested.
+
+    Args:
+        featvecs (array float): Feature matrix (num_examples, num_features).
+        labels (array int/float): Label of every example.
+        shuffle (bool): Shuffle the examples before the first epoch,
+                        later epochs are always shuffled.
+        stratified (bool): Spread every label evenly over the epoch, so
+                           every batch has about the overall label distribution.
+        prefetch (int): Number of batches a background thread gathers ahead, 0 to disable.
+
+    Sampling uses its own random generator, seeded from np.random. state_dict()
+    returns the sampling state after the last returned batch, also when
+    prefetching, so training can resume with the next batch. The prefetch
+    thread stops on close() or when the DataClass is garbage collected.
+    """
 
-        
+    def __init__(self, featvecs, labels, shuffle=False, stratified=False, prefetch=0):
         self._num_examples = featvecs.shape[0]
-        self._featvecs = torch.from_numpy(featvecs).float()
-        self._labels = torch.from_numpy(labels).float()
+        self._featvecs = torch.from_numpy(np.ascontiguousarray(featvecs, dtype=np.float32))
+        self._labels = torch.from_numpy(np.ascontiguousarray(labels, dtype=np.float32))
+        self._pin = torch.cuda.is_available()
+        if self._pin:
+            self._featvecs = self._featvecs.pin_memory()
+            self._labels = self._labels.pin_memory()
+        self._label_values = np.asarray(labels)
+        self._stratified = stratified
+        self._rng = np.random.RandomState(np.random.randint(2 ** 31))
+
         if shuffle:
-            perm = np.arange(self._num_examples)
-            np.random.shuffle(perm)
-            self._featvecs = self._featvecs[perm]
-            self._labels = self._labels[perm]
-            
+            self._perm = self._permutation()
+        else:
+            self._perm = np.arange(self._num_examples)
         self._epochs_completed = 0
         self._index_in_epoch = 0
 
+        self._prefetch = prefetch
+        self._buffers = []
+        self._buffer_index = 0
+        self._queue = None
+        self._prefetch_batch_size = None
+        self._batch_state = None
+
     @property
     def featvecs(self):
+        # in the original order, use next_batch for shuffled batches
         return self._featvecs
 
     @property
@@ -416,26 +665,388 @@ class DataClass(object):
 
     @property
     def epochs_completed(self):
+        if self._queue is not None:
+            # the prefetch thread runs ahead, report the epoch of the last returned batch
+            return self._batch_state['epochs_completed']
         return self._epochs_completed
 
-    def next_batch(self, batch_size):
-
+    def _sampling_state(self):
+        # a new permutation is made every epoch, so the array itself does not change later on
+        return {'perm': self._perm, 'index_in_epoch': self._index_in_epoch,
+                'epochs_completed': self._epochs_completed, 'rng_state': self._rng.get_state()}
+
+    def state_dict(self):
+        if self._queue is not None:
+            return dict(self._batch_state)
+        return self._sampling_state()
+
+    def load_state_dict(self, state):
+        assert self._queue is None, 'the sampling state cannot be changed once prefetching started'
+        self._perm = state['perm']
+        self._index_in_epoch = state['index_in_epoch']
+        self._epochs_completed = state['epochs_completed']
+        self._rng.set_state(state['rng_state'])
+
+    def _permutation(self):
+        if not self._stratified:
+            return self._rng.permutation(self._num_examples)
+        # Give every example a position in [0, 1) spread evenly within its label,
+        # sorting on the positions interleaves the labels proportionally.
+        values, label_index, counts = np.unique(self._label_values, return_inverse=True, return_counts=True)
+        label_index = label_index.reshape(-1)
+        order = np.lexsort((self._rng.uniform(size=self._num_examples), label_index))
+        rank_in_label = np.empty(self._num_examples)
+        rank_in_label[order] = np.arange(self._num_examples) - np.repeat(np.cumsum(counts) - counts, counts)
+        position = (rank_in_label + self._rng.uniform(size=self._num_examples)) / counts[label_index]
+        return np.argsort(position)
+
+    def _next_indices(self, batch_size):
         start = self._index_in_epoch
         self._index_in_epoch += batch_size
         if self._index_in_epoch > self._num_examples:
             self._epochs_completed += 1
-            
-            perm = np.arange(self._num_examples)
-            np.random.shuffle(perm)
-            self._featvecs = self._featvecs[perm]
-            self._labels = self._labels[perm]
+
+            self._perm = self._permutation()
 
             start = 0
             self._index_in_epoch = batch_size
             assert batch_size <= self._num_examples
 
         end = self._index_in_epoch
-        return self._featvecs[start:end], self._labels[start:end].view(-1,1)
+        return torch.from_numpy(self._perm[start:end])
+
+    def _pinned_buffers(self, batch_size):
+        if not self._buffers or self._buffers[0][0].shape[0] != batch_size:
+            # one buffer per batch in the queue, plus the one being gathered and the one in use
+            self._buffers = [(torch.empty((batch_size, self._featvecs.shape[1])).pin_memory(),
+                              torch.empty((batch_size, 1)).pin_memory())
+                             for _ in range(max(self._prefetch, 0) + 2)]
+            self._buffer_index = 0
+        buffers = self._buffers[self._buffer_index]
+        self._buffer_index = (self._buffer_index + 1) % len(self._buffers)
+        return buffers
+
+    def _gather(self, indices):
+        if not self._pin:
+            featvecs = torch.index_select(self._featvecs, 0, indices)
+            labels = torch.index_select(self._labels, 0, indices).view(-1,1)
+            return featvecs, labels
+        featvecs, labels = self._pinned_buffers(indices.shape[0])
+        # out= does not support autograd, in case a caller set requires_grad on a returned batch
+        featvecs.requires_grad_(False)
+        labels.requires_grad_(False)
+        torch.index_select(self._featvecs, 0, indices, out=featvecs)
+        torch.index_select(self._labels, 0, indices, out=labels.view(-1))
+        return featvecs, labels
+
+    @staticmethod
+    def _prefetch_worker(ref, batch_size, batches, stop):
+        # only a weak reference is kept between batches, so the DataClass can be garbage collected
+        while not stop.is_set():
+            self = ref()
+            if self is None:
+                return
+            batch = self._gather(self._next_indices(batch_size)) + (self._sampling_state(),)
+            del self
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    @staticmethod
+    def _stop_prefetch(stop, thread):
+        # a thread that is killed halfway through a torch call at exit aborts the interpreter
+        stop.set()
+        # the worker itself can drop the last reference to the DataClass
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def close(self):
+        """
+        Stops prefetching, a later next_batch continues after the last returned batch.
+        """
+        if self._queue is None:
+            return
+        self._stop_prefetch_thread()
+        self._queue = None
+        self.load_state_dict(self._batch_state)
+
+    def next_batch(self, batch_size):
+        if self._prefetch <= 0:
+            return self._gather(self._next_indices(batch_size))
+
+        if self._queue is None or batch_size != self._prefetch_batch_size:
+            assert self._queue is None, 'the batch size cannot change when prefetching'
+            self._queue = queue.Queue(maxsize=self._prefetch)
+            self._prefetch_batch_size = batch_size
+            # the worker owns the sampling state from now on
+            stop = threading.Event()
+            thread = threading.Thread(target=self._prefetch_worker,
+                                      args=(weakref.ref(self), batch_size, self._queue, stop), daemon=True)
+            thread.start()
+            # runs when the DataClass is garbage collected or at exit, whichever comes first
+            self._stop_prefetch_thread = weakref.finalize(self, self._stop_prefetch, stop, thread)
+        featvecs, labels, self._batch_state = self._queue.get()
+        return featvecs, labels
+
+
+class QueryBatchLoader(object):
+    """
+    Iterates over the queries of a DataFoldSplit in batches of padded tensors.
+
+    When shuffling, queries are grouped by size, so that queries of similar
+    length share a batch and little padding is needed, and the batches are
+    visited in random order. Without shuffling the queries are batched in
+    their original order, so no ordering by size is imposed. Every batch is a tuple of
+    features (batch, max_docs, num_features), labels (batch, max_docs),
+    mask (batch, max_docs), which is False for padding, and the query indices.
+
+    state_dict() holds the batches of the current epoch and how many of them
+    were returned, after load_state_dict() the next iteration continues that epoch.
+    """
+
+    def __init__(self, data_split, batch_size=100, shuffle=True, min_docs=1, device='cpu'):
+        self.data_split = data_split
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        sizes = data_split.query_sizes()
+        self.query_indices = np.where(sizes >= min_docs)[0]
+        self.sizes = sizes[self.query_indices]
+        self._epoch_batches = []
+        self._position = 0
+        self._resume = False
+
+    def __len__(self):
+        return int(np.ceil(self.query_indices.shape[0] / self.batch_size))
+
+    def batches(self):
+        """
+        Returns the query indices of every batch for one pass over the data.
+        """
+        if self.shuffle:
+            # sort by size with random tie breaking, then shuffle the batches
+            order = np.lexsort((np.random.rand(self.sizes.shape[0]), self.sizes))
+        else:
+            order = np.arange(self.sizes.shape[0])
+        batches = [self.query_indices[order[i:i + self.batch_size]]
+                   for i in range(0, order.shape[0], self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def make_batch(self, query_indices):
+        split = self.data_split
+        starts = split.doclist_ranges[query_indices]
+        sizes = split.doclist_ranges[query_indices + 1] - starts
+        max_docs = np.amax(sizes)
+
+        # for every document: its row in the split, its query in the batch and its position in that query
+        batch_i = np.repeat(np.arange(query_indices.shape[0]), sizes)
+        doc_i = np.arange(batch_i.shape[0]) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        rows = np.repeat(starts, sizes) + doc_i
+
+        features = np.zeros((query_indices.shape[0], max_docs, split.feature_matrix.shape[1]), dtype=np.float32)
+        labels = np.zeros((query_indices.shape[0], max_docs), dtype=np.float32)
+        mask = np.zeros((query_indices.shape[0], max_docs), dtype=bool)
+        features[batch_i, doc_i] = split.feature_matrix[rows]
+        labels[batch_i, doc_i] = split.label_vector[rows]
+        mask[batch_i, doc_i] = True
+
+        return (torch.from_numpy(features).to(self.device),
+                torch.from_numpy(labels).to(self.device),
+                torch.from_numpy(mask).to(self.device),
+                query_indices)
+
+    def state_dict(self):
+        return {'batches': self._epoch_batches, 'position': self._position}
+
+    def load_state_dict(self, state):
+        self._epoch_batches = state['batches']
+        self._position = state['position']
+        self._resume = True
+
+    def __iter__(self):
+        if not self._resume:
+            self._epoch_batches = self.batches()
+            self._position = 0
+        self._resume = False
+        while self._position < len(self._epoch_batches):
+            query_indices = self._epoch_batches[self._position]
+            self._position += 1
+            yield self.make_batch(query_indices)
+
+
+class QueryStream(object):
+    """
+    Streams batches of queries from a DataFoldSplit that is too large for memory.
+
+    The split (normally a memory-mapped one from the fold cache) is only read
+    sequentially, in blocks of consecutive queries of about block_docs
+    documents. Queries are shuffled by visiting the blocks in random order and
+    passing the queries through a buffer of shuffle_buffer queries, so at most
+    one block and the buffer are in memory. A background thread prepares
+    `prefetch` batches ahead. Batches have the same format as QueryBatchLoader.
+
+    The stream shuffles with its own random generator, seeded from np.random.
+    state_dict() holds its state at the start of the epoch and the number of
+    batches returned, after load_state_dict() the next iteration replays the
+    epoch and skips the batches that were already returned.
+    """
+
+    def __init__(self, data_split, batch_size=100, shuffle=True, min_docs=1, device='cpu',
+                 shuffle_buffer=1000, block_docs=64 * 1024, prefetch=2):
+        self.data_split = data_split
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.min_docs = min_docs
+        self.device = device
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self._rng = np.random.RandomState(np.random.randint(2 ** 31))
+        self._epoch_rng_state = self._rng.get_state()
+        self._position = 0
+        self._skip = 0
+
+        ranges = data_split.doclist_ranges
+        self.num_queries = int(np.sum(data_split.query_sizes() >= min_docs))
+        # blocks of whole queries, starting at the first query past every block_docs documents
+        boundaries = np.searchsorted(ranges[:-1], np.arange(0, ranges[-1], block_docs), side='left')
+        self.blocks = np.unique(np.append(boundaries, ranges.shape[0] - 1))
+
+    def __len__(self):
+        return int(np.ceil(self.num_queries / self.batch_size))
+
+    def _queries(self):
+        split = self.data_split
+        ranges = split.doclist_ranges
+        block_order = np.arange(self.blocks.shape[0] - 1)
+        if self.shuffle:
+            self._rng.shuffle(block_order)
+        for b in block_order:
+            q_s, q_e = self.blocks[b], self.blocks[b + 1]
+            s_i, e_i = ranges[q_s], ranges[q_e]
+            # one sequential read per block
+            features = np.asarray(split.feature_matrix[s_i:e_i], dtype=np.float32)
+            labels = np.asarray(split.label_vector[s_i:e_i], dtype=np.float32)
+            for q in range(q_s, q_e):
+                if ranges[q + 1] - ranges[q] >= self.min_docs:
+                    yield (q,
+                           features[ranges[q] - s_i:ranges[q + 1] - s_i],
+                           labels[ranges[q] - s_i:ranges[q + 1] - s_i])
+
+    def _shuffled(self, queries):
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            for query in queries:
+                yield query
+            return
+        buffer = []
+        for query in queries:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(query)
+                continue
+            # emit a random query from the buffer and put the new one in its place
+            i = self._rng.randint(len(buffer))
+            yield buffer[i]
+            buffer[i] = query
+        self._rng.shuffle(buffer)
+        for query in buffer:
+            yield query
+
+    def _make_batch(self, queries):
+        sizes = np.array([len(labels) for _, _, labels in queries])
+        features = np.zeros((len(queries), np.amax(sizes), queries[0][1].shape[1]), dtype=np.float32)
+        labels = np.zeros((len(queries), np.amax(sizes)), dtype=np.float32)
+        mask = np.zeros((len(queries), np.amax(sizes)), dtype=bool)
+        for i, (_, q_features, q_labels) in enumerate(queries):
+            features[i, :sizes[i]] = q_features
+            labels[i, :sizes[i]] = q_labels
+            mask[i, :sizes[i]] = True
+        return features, labels, mask, np.array([q for q, _, _ in queries])
+
+    def _batches(self, skip=0):
+        batch = []
+        for query in self._shuffled(self._queries()):
+            batch.append(query)
+            if len(batch) == self.batch_size:
+                if skip > 0:
+                    skip -= 1
+                else:
+                    yield self._make_batch(batch)
+                batch = []
+        if batch and skip == 0:
+            yield self._make_batch(batch)
+
+    def _produce(self, batches, stop, skip):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self._batches(skip):
+                if not put(batch):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def _to_tensors(self, batch):
+        features, labels, mask, query_indices = batch
+        return (torch.from_numpy(features).to(self.device),
+                torch.from_numpy(labels).to(self.device),
+                torch.from_numpy(mask).to(self.device),
+                query_indices)
+
+    def state_dict(self):
+        return {'rng_state': self._epoch_rng_state, 'position': self._position}
+
+    def load_state_dict(self, state):
+        self._rng.set_state(state['rng_state'])
+        self._skip = state['position']
+
+    def __iter__(self):
+        # the generator only changes in the epoch itself, so this state replays it
+        self._epoch_rng_state = self._rng.get_state()
+        skip, self._skip = self._skip, 0
+        self._position = skip
+        if self.prefetch <= 0:
+            for batch in self._batches(skip):
+                self._position += 1
+                yield self._to_tensors(batch)
+            return
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        threading.Thread(target=self._produce, args=(batches, stop, skip), daemon=True).start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                self._position += 1
+                yield self._to_tensors(batch)
+        finally:
+            # also stops the thread when the loop is left early, e.g. by early stopping
+            stop.set()
+
+
+def query_loader(data_split, batch_size=100, shuffle=True, min_docs=1, device='cpu', streaming=False):
+    """
+    Returns a QueryStream if streaming, for splits that do not fit in memory,
+    and a QueryBatchLoader otherwise.
+    """
+    if streaming:
+        return QueryStream(data_split, batch_size, shuffle, min_docs, device)
+    return QueryBatchLoader(data_split, batch_size, shuffle, min_docs, device)
 
 
 if __name__ == "__main__":
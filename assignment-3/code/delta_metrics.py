@@ -0,0 +1,237 @@
+"""
+Vectorized computation of how much NDCG or ERR changes when two documents
+swap places in the current ranking, for all pairs of a query at once.
+
+As in pairwise.py, the functions accept tensors of shape (n_docs,) or a
+padded batch of shape (n_queries, max_docs) together with a mask.
+
+truncated_lambdas only considers the pairs with a document in the current
+top k, optionally a sample of them, so that long candidate lists do not
+need n_docs x n_docs matrices.
+"""
+import torch
+
+import pairwise
+
+
+def rank_positions(scores, mask=None):
+  """
+  Returns the (0-based) rank of every document when sorted by descending score,
+  padding documents are ranked last.
+  """
+  if mask is not None:
+    scores = scores.masked_fill(~mask, float('-inf'))
+  order = torch.argsort(scores, dim=-1, descending=True)
+  positions = torch.arange(scores.shape[-1], device=scores.device).expand_as(order)
+  return torch.empty_like(order).scatter_(-1, order, positions), order
+
+
+def ideal_dcg(labels, mask=None):
+  """
+  The DCG of the ideal ranking over all documents of the query.
+  """
+  if mask is not None:
+    labels = labels * mask
+  sorted_labels, _ = torch.sort(labels, dim=-1, descending=True)
+  discounts = 1. / torch.log2(torch.arange(labels.shape[-1], device=labels.device) + 2.)
+  return torch.sum((2 ** sorted_labels - 1.) * discounts, dim=-1)
+
+
+def delta_ndcg(scores, labels, mask=None, query_dcg=None):
+  """
+  |delta NDCG| of swapping every pair of documents, from the rank discounts:
+  |(g_i - g_j) * (1/log2(r_i + 2) - 1/log2(r_j + 2))| / ideal DCG.
+
+  Args:
+      scores (tensor float): Current scores of the documents.
+      labels (tensor float): Relevance labels of the documents.
+      mask (tensor bool): Which documents are real (not padding), optional.
+      query_dcg (tensor float): The ideal DCG of the query (one per query),
+                                computed from the labels if not given.
+
+  Returns:
+      tensor float: The delta of every pair, shape (..., n_docs, n_docs).
+  """
+  if mask is not None:
+    labels = labels * mask
+  if query_dcg is None:
+    query_dcg = ideal_dcg(labels)
+  ranks, _ = rank_positions(scores, mask)
+  gains = 2 ** labels - 1.
+  discounts = 1. / torch.log2(ranks.to(scores.dtype) + 2.)
+  delta = torch.abs((gains.unsqueeze(-1) - gains.unsqueeze(-2))
+                    * (discounts.unsqueeze(-1) - discounts.unsqueeze(-2)))
+  # same smoothing as evaluate.ndcg_speed
+  return delta / (query_dcg.unsqueeze(-1).unsqueeze(-1) + 1e-8)
+
+
+def _err_terms(R):
+  """
+  For the stopping probabilities R in ranking order: the probability P_r of
+  reaching position r, the ERR term T_r of every position and their cumulative sum C.
+  """
+  position = torch.arange(R.shape[-1], device=R.device, dtype=R.dtype)
+  # exclusive cumulative product, R < 1 so the log is finite
+  P = torch.exp(torch.cumsum(torch.log1p(-R), dim=-1) - torch.log1p(-R))
+  T = P * R / (position + 1.)
+  return P, T, torch.cumsum(T, dim=-1)
+
+
+def delta_err(scores, labels, mask=None):
+  """
+  |delta ERR| of swapping every pair of documents, with the ERR of
+  evaluate.err (grades are normalized by the maximum label of the query).
+
+  Swapping the documents at positions a < b only changes the terms of
+  positions a to b: the stopping probability of everything in between is
+  scaled by (1 - R_b) / (1 - R_a). With the ranking in position order,
+  P_r the probability of reaching position r and T_r = P_r R_r / (r + 1):
+
+    delta = (R_b - R_a) P_a / (a + 1)
+            + ((1 - R_b) / (1 - R_a) - 1) * sum_{a < r < b} T_r
+            + P_b ((1 - R_b) / (1 - R_a) R_a - R_b) / (b + 1)
+  """
+  if mask is not None:
+    labels = labels * mask
+  ranks, order = rank_positions(scores, mask)
+  g_max = torch.amax(labels, dim=-1, keepdim=True)
+  R = (2 ** labels - 1.) / (2 ** g_max)
+  R = torch.gather(R, -1, order)
+
+  n_docs = scores.shape[-1]
+  position = torch.arange(n_docs, device=scores.device, dtype=scores.dtype)
+  P, T, C = _err_terms(R)
+
+  # a indexes rows, b columns, only a < b is used
+  R_a, R_b = R.unsqueeze(-1), R.unsqueeze(-2)
+  P_a, P_b = P.unsqueeze(-1), P.unsqueeze(-2)
+  ratio = (1. - R_b) / (1. - R_a)
+  between = (torch.cat([torch.zeros_like(C[..., :1]), C[..., :-1]], dim=-1).unsqueeze(-2)
+             - C.unsqueeze(-1)).clamp(min=0.)
+  delta = ((R_b - R_a) * P_a / (position.unsqueeze(-1) + 1.)
+           + (ratio - 1.) * between
+           + P_b * (ratio * R_a - R_b) / (position.unsqueeze(-2) + 1.))
+  delta = torch.abs(torch.triu(delta, diagonal=1))
+  delta = delta + delta.transpose(-1, -2)
+
+  # from positions back to documents
+  rows = ranks.unsqueeze(-1).expand(*ranks.shape, n_docs)
+  delta = torch.gather(delta, -2, rows)
+  return torch.gather(delta, -1, ranks.unsqueeze(-2).expand_as(delta))
+
+
+def lambda_weights(scores, labels, mask=None, metric='ndcg', query_dcg=None):
+  """
+  The |delta metric| matrix that LambdaRank multiplies the RankNet lambdas with,
+  pairs involving padding documents get zero weight.
+  """
+  if metric == 'ndcg':
+    weights = delta_ndcg(scores, labels, mask, query_dcg)
+  elif metric == 'err':
+    weights = delta_err(scores, labels, mask)
+  else:
+    raise ValueError('Unknown metric: %s' % metric)
+  if mask is not None:
+    weights = weights * (mask.unsqueeze(-1) & mask.unsqueeze(-2))
+  return weights
+
+
+def _at_positions(x, b):
+  """
+  x (batch, n_docs) at the positions b (batch, k, m).
+  """
+  return torch.gather(x.unsqueeze(-2).expand(*b.shape[:-1], x.shape[-1]), -1, b)
+
+
+def truncated_lambdas(scores, labels, sigma=1.0, mask=None, metric='ndcg', query_dcg=None, k=10,
+                      num_samples=None):
+  """
+  The LambdaRank lambda of every document, sum_j lambda_ij * |delta metric|,
+  with only the pairs in which at least one document is in the current top k.
+  With k >= n_docs this equals summing the full lambda_weights matrix.
+
+  Pairs are handled in ranking order: row a is one of the top k positions,
+  column b a lower position, so every pair is counted once and lambda_ij
+  is added to the document at a and subtracted from the one at b.
+
+  Args:
+      scores (tensor float): Current scores of the documents.
+      labels (tensor float): Relevance labels of the documents.
+      sigma (float): Sigma of RankNet.
+      mask (tensor bool): Which documents are real (not padding), optional.
+      metric (str): 'ndcg' or 'err'.
+      query_dcg (tensor float): The ideal DCG of the query (one per query),
+                                computed from the labels if not given.
+      k (int): Number of top positions that pairs are formed with.
+      num_samples (int): If given, every top position is paired with this many
+                         positions below it, sampled uniformly, and weighted with
+                         (positions below) / num_samples, which keeps the expected
+                         lambdas equal to those of all its pairs. The work is then
+                         k * num_samples per query instead of k * n_docs.
+
+  Returns:
+      tensor float: The lambdas, the same shape as scores.
+  """
+  single = scores.dim() == 1
+  if single:
+    scores, labels = scores.unsqueeze(0), labels.unsqueeze(0)
+    mask = mask.unsqueeze(0) if mask is not None else None
+    query_dcg = query_dcg.reshape(1) if query_dcg is not None else None
+  if mask is None:
+    mask = torch.ones_like(scores, dtype=torch.bool)
+  labels = labels * mask
+  if metric == 'ndcg' and query_dcg is None:
+    query_dcg = ideal_dcg(labels)
+
+  ranks, order = rank_positions(scores, mask)
+  n_queries, n_docs = scores.shape
+  k = min(k, n_docs)
+  # everything in ranking order
+  s = torch.gather(scores, -1, order)
+  g = torch.gather(labels, -1, order)
+  m = torch.gather(mask, -1, order)
+  position = torch.arange(n_docs, device=scores.device)
+
+  a = position[:k].view(1, k, 1)
+  if num_samples is None:
+    b = position.view(1, 1, n_docs).expand(n_queries, k, n_docs)
+    weight = 1.
+  else:
+    # the real documents take the first positions, padding is ranked last
+    below = (m.sum(dim=-1, keepdim=True) - position[:k] - 1).clamp(min=0)
+    offsets = torch.floor(torch.rand(n_queries, k, num_samples, device=scores.device)
+                          * below.unsqueeze(-1)).long()
+    b = (a + 1 + offsets).clamp(max=n_docs - 1)
+    weight = below.unsqueeze(-1).to(scores.dtype) / num_samples
+
+  g_a, g_b = g[:, :k].unsqueeze(-1), _at_positions(g, b)
+  valid = (b > a) & m[:, :k].unsqueeze(-1) & _at_positions(m, b) & (g_a != g_b)
+  lambdas = pairwise.lambda_ij(s[:, :k].unsqueeze(-1) - _at_positions(s, b), torch.sign(g_a - g_b), sigma)
+
+  if metric == 'ndcg':
+    gains = 2 ** g - 1.
+    discounts = 1. / torch.log2(position.to(scores.dtype) + 2.)
+    delta = torch.abs((gains[:, :k].unsqueeze(-1) - _at_positions(gains, b))
+                      * (discounts[:k].view(1, k, 1) - discounts[b]))
+    delta = delta / (query_dcg.view(-1, 1, 1) + 1e-8)
+  elif metric == 'err':
+    # the closed form of delta_err, for positions a < b
+    R = (2 ** g - 1.) / (2 ** torch.amax(g, dim=-1, keepdim=True))
+    P, T, C = _err_terms(R)
+    R_a, R_b = R[:, :k].unsqueeze(-1), _at_positions(R, b)
+    P_a, P_b = P[:, :k].unsqueeze(-1), _at_positions(P, b)
+    ratio = (1. - R_b) / (1. - R_a)
+    between = (_at_positions(C - T, b) - C[:, :k].unsqueeze(-1)).clamp(min=0.)
+    delta = torch.abs((R_b - R_a) * P_a / (a + 1.)
+                      + (ratio - 1.) * between
+                      + P_b * (ratio * R_a - R_b) / (b + 1.))
+  else:
+    raise ValueError('Unknown metric: %s' % metric)
+
+  pair_lambdas = lambdas * delta * valid * weight
+  position_lambdas = torch.zeros_like(s)
+  position_lambdas[:, :k] += torch.sum(pair_lambdas, dim=-1)
+  position_lambdas.scatter_add_(-1, b.reshape(n_queries, -1), -pair_lambdas.reshape(n_queries, -1))
+  # from positions back to documents
+  result = torch.gather(position_lambdas, -1, ranks)
+  return result[0] if single else result
@@ -116,7 +116,7 @@ def evaluate_labels_scores(labels, scores):
   return result
 
 def included(qid, data_split):
-  return np.any(np.greater(data_split.query_labels(qid), 0))
+  return data_split.included_mask[qid]
 
 def add_to_results(results, cur_results):
   for k, v in cur_results.items():
@@ -127,17 +127,102 @@ def add_to_results(results, cur_results):
     else:
       results[k].append(v)
 
-def evaluate(data_split, all_scores, print_results=False):
+def _segment_sum(values, starts):
+  return np.add.reduceat(values, starts) if values.shape[0] > 0 else np.zeros(0)
+
+def evaluate(data_split, all_scores, print_results=False, metrics=None):
+  """
+  Evaluates the scores of all documents in a split, gives the same
+  results as calling evaluate_query for every included query.
+
+  All queries are ranked with a single lexsort on (query, -score, noise)
+  and the metrics of every query are computed at once with cumulative
+  sums and reduceat over the query ranges.
+
+  Args:
+      data_split (DataFoldSplit): The split the scores belong to.
+      all_scores (array float): The scores of all documents in the split.
+      print_results (bool): Whether to print the results.
+      metrics (list str): Only compute these metrics, all of them if None.
+
+  Returns:
+      dict: For every metric its (mean, standard deviation) over the queries.
+  """
+  def wanted(*names):
+    return metrics is None or any(name in metrics for name in names)
+
+  ranges = data_split.doclist_ranges
+  sizes = ranges[1:] - ranges[:-1]
+  labels = np.asarray(data_split.label_vector)
+  all_scores = np.asarray(all_scores).reshape(-1)
+  n_docs = labels.shape[0]
+  n_queries = sizes.shape[0]
+  doc_query = np.repeat(np.arange(n_queries), sizes)
+  starts = ranges[:-1]
+  # 0-based rank of every position within its query
+  rank = np.arange(n_docs) - np.repeat(starts, sizes)
+
+  # rank every query by descending score, with random tie breaking
+  noise = np.random.uniform(size=n_docs)
+  sorted_labels = labels[np.lexsort((noise, -all_scores, doc_query))]
+
+  # the ideal DCGs and label statistics are precomputed by the split
+  max_label = data_split.max_label
+  included = data_split.included_mask
+
   results = {}
-  for qid in np.arange(data_split.num_queries()):
-    if included(qid, data_split):
-      add_to_results(results, evaluate_query(data_split, qid, all_scores))
+  if wanted('dcg', 'dcg@03', 'dcg@05', 'dcg@10', 'dcg@20',
+            'ndcg', 'ndcg@03', 'ndcg@05', 'ndcg@10', 'ndcg@20'):
+    gains = (2**sorted_labels-1.)/np.log2(rank+2.)
+    for k, name in [(0, ''), (3, '@03'), (5, '@05'), (10, '@10'), (20, '@20')]:
+      in_top = rank < k if k > 0 else np.ones(n_docs, dtype=bool)
+      dcg = _segment_sum(gains*in_top, starts)[included]
+      if wanted('dcg' + name):
+        results['dcg' + name] = dcg
+      if wanted('ndcg' + name):
+        results['ndcg' + name] = dcg/data_split.ideal_dcg[included, dataset.IDEAL_DCG_CUTOFFS.index(k)]
+
+  if wanted('err', 'err_rank_net'):
+    R = (2**sorted_labels-1.)/(2**np.repeat(max_label, sizes))
+    # probability of reaching every position, the product of 1 - R before it
+    log_not_R = np.log1p(-R)
+    log_P = np.cumsum(log_not_R) - log_not_R
+    log_P -= np.repeat(log_P[starts] if n_docs > 0 else log_P, sizes)
+    err_q = _segment_sum(np.exp(log_P)*R/(rank+1.), starts)[included]
+    if wanted('err'):
+      results['err'] = err_q
+    if wanted('err_rank_net'):
+      # err_rank_net computes the same quantity
+      results['err_rank_net'] = err_q
+
+  # precision, recall and ranks are only computed for queries with documents labelled above 2
+  bin_labels = np.greater(sorted_labels, dataset.RELEVANT_LABEL)
+  total_labels = data_split.num_relevant.astype(np.float64)
+  binary = total_labels > 0
+  for k, name in [(1, '@01'), (3, '@03'), (5, '@05'), (10, '@10'), (20, '@20')]:
+    if wanted('precision' + name, 'recall' + name):
+      n_rel = _segment_sum((bin_labels & (rank < k)).astype(np.float64), starts)[binary]
+      if wanted('precision' + name):
+        results['precision' + name] = n_rel/float(k)
+      if wanted('recall' + name):
+        results['recall' + name] = n_rel/total_labels[binary]
+  if wanted('relevant rank', 'relevant rank per query', 'arr'):
+    rel_rank = (rank+1.)*bin_labels
+    rank_sum = _segment_sum(rel_rank, starts)[binary]
+    if wanted('relevant rank'):
+      results['relevant rank'] = rel_rank[bin_labels]
+    if wanted('relevant rank per query'):
+      results['relevant rank per query'] = rank_sum
+    if wanted('arr'):
+      results['arr'] = rank_sum/sizes[binary]
 
   if print_results:
     print('"metric": "mean" ("standard deviation")')
   mean_results = {}
   for k in sorted(results.keys()):
     v = results[k]
+    if v.shape[0] == 0:
+      continue
     mean_v = np.mean(v)
     std_v = np.std(v)
     mean_results[k] = (mean_v, std_v)
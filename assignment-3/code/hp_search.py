@@ -0,0 +1,199 @@
+"""
+Parallel hyperparameter search for RankNet and LambdaRank.
+
+Configurations are trained concurrently on a process pool. All processes
+memory-map the same cached fold, so the data is read from disk once and
+shared through the page cache. Bad configurations are stopped early based
+on the validation NDCG curves of the other trials, and a leaderboard with
+the wall time of every trial is written at the end.
+"""
+import os
+import csv
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import dataset
+from cross_validation import MODELS, DEFAULT_PARAMS, train_model, limit_threads
+from monitor import ValidationMonitor
+
+SEARCH_SPACES = {
+    'rank_net': {
+        'lr': [2e-3, 1e-3, 5e-4],
+        'hidden': [[200], [200, 100], [200, 100, 50]],
+        'sigma': [1.0],
+    },
+    'rank_net_sped_up': {
+        'lr': [2e-3, 1e-3, 5e-4],
+        'hidden': [[200], [200, 100], [200, 100, 50]],
+        'sigma': [1.0],
+    },
+    'lambda_rank': {
+        'lr': [1e-4, 1e-5, 1e-6],
+        'hidden': [[200, 100], [200, 100, 50]],
+        'sigma': [1.0],
+    },
+}
+
+
+def grid(search_space):
+    """
+    All combinations of the values in the search space, as a list of parameter dicts.
+    """
+    names = sorted(search_space)
+    return [dict(zip(names, values)) for values in itertools.product(*[search_space[n] for n in names])]
+
+
+class Pruner(object):
+    """
+    Decides whether a trial should stop, by comparing its validation NDCG curve
+    to the curves of the other trials. The curves are kept in a dict that is
+    shared between the processes.
+
+    mode 'median': stop when the best NDCG of the trial is below the median of
+                   the best NDCGs of the other trials after as many evaluations.
+    mode 'halving': asynchronous successive halving, after min_evals * eta^k
+                    evaluations a trial only continues if it is in the top
+                    1/eta of the trials that got that far.
+    mode None: never stop early.
+    """
+
+    def __init__(self, curves, mode='halving', min_evals=3, eta=3, min_trials=3):
+        self.curves = curves
+        self.mode = mode
+        self.min_evals = min_evals
+        self.eta = eta
+        self.min_trials = min_trials
+
+    def _is_rung(self, n):
+        rung = self.min_evals
+        while rung < n:
+            rung *= self.eta
+        return rung == n
+
+    def should_stop(self, trial_id, curve):
+        n = len(curve)
+        if self.mode is None or n < self.min_evals:
+            return False
+        if self.mode == 'halving' and not self._is_rung(n):
+            return False
+        # best value of every other trial after the same number of evaluations
+        others = [max(c[:n]) for t, c in self.curves.items() if t != trial_id and len(c) >= n]
+        if len(others) + 1 < self.min_trials:
+            return False
+        if self.mode == 'median':
+            return max(curve) < np.median(others)
+        elif self.mode == 'halving':
+            values = sorted(others + [max(curve)], reverse=True)
+            keep = max(1, len(values) // self.eta)
+            return max(curve) < values[keep - 1]
+        raise ValueError('Unknown pruning mode: %s' % self.mode)
+
+
+class TrialCallback(object):
+    """
+    ValidationMonitor callback that reports the curve of a trial and asks the pruner whether to stop.
+    """
+
+    def __init__(self, trial_id, pruner):
+        self.trial_id = trial_id
+        self.pruner = pruner
+        self.curve = []
+        self.pruned = False
+
+    def __call__(self, step, value, results):
+        self.curve.append(value)
+        self.pruner.curves[self.trial_id] = list(self.curve)
+        self.pruned = self.pruner.should_stop(self.trial_id, self.curve)
+        return self.pruned
+
+
+def run_trial(trial_id, model_name, params, pruner, fold_num=0, num_folds=1):
+    start = time.time()
+    data = dataset.get_dataset(num_folds=num_folds).get_data_folds()[fold_num]
+    data.read_data()
+    callback = TrialCallback(trial_id, pruner)
+    module, _ = train_model(model_name, data, params, name_suffix='_trial%d' % trial_id, callback=callback)
+    device = next(module.parameters()).device
+    results = ValidationMonitor(data.validation, device=device).evaluate(module, metrics=['ndcg', 'err'])
+    return {
+        'trial': trial_id,
+        'params': params,
+        'best_ndcg': max(callback.curve) if callback.curve else results['ndcg'][0],
+        'ndcg': results['ndcg'][0],
+        'err': results['err'][0],
+        'num_evals': len(callback.curve),
+        'pruned': callback.pruned,
+        'time': time.time() - start,
+    }
+
+
+def search(model_name, configs, num_workers=None, threads_per_worker=None, prune='halving',
+           min_evals=3, eta=3, fold_num=0, num_folds=1):
+    """
+    Trains all configurations on a process pool and returns the trials sorted by their best validation NDCG.
+    """
+    if num_workers is None:
+        num_workers = min(len(configs), os.cpu_count() or 1)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+    # read the fold once here, so the workers only memory-map the cache instead of all parsing it at once
+    dataset.get_dataset(num_folds=num_folds).get_data_folds()[fold_num].read_data()
+
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        pruner = Pruner(manager.dict(), prune, min_evals, eta)
+        with ProcessPoolExecutor(num_workers, mp_context=context, initializer=limit_threads,
+                                 initargs=(threads_per_worker,)) as executor:
+            futures = [executor.submit(run_trial, trial_id, model_name, dict(DEFAULT_PARAMS, **params), pruner,
+                                       fold_num, num_folds)
+                       for trial_id, params in enumerate(configs)]
+            trials = [future.result() for future in futures]
+    return sorted(trials, key=lambda trial: trial['best_ndcg'], reverse=True)
+
+
+def write_leaderboard(trials, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial', 'lr', 'hidden', 'sigma', 'best_ndcg', 'ndcg', 'err',
+                         'num_evals', 'pruned', 'seconds'])
+        for rank, trial in enumerate(trials):
+            params = trial['params']
+            writer.writerow([rank + 1, trial['trial'], params['lr'], params['hidden'], params['sigma'],
+                             '%0.4f' % trial['best_ndcg'], '%0.4f' % trial['ndcg'], '%0.4f' % trial['err'],
+                             trial['num_evals'], trial['pruned'], '%0.1f' % trial['time']])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=MODELS, default='rank_net_sped_up')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    parser.add_argument('--prune', choices=['halving', 'median', 'none'], default='halving')
+    parser.add_argument('--min_evals', type=int, default=3,
+                        help='Number of evaluations before a trial can be stopped')
+    parser.add_argument('--eta', type=int, default=3, help='Reduction factor of successive halving')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_PARAMS['batch_size'])
+    parser.add_argument('--num_epochs', type=int, default=3)
+    parser.add_argument('--eval_freq', type=int, default=100)
+    FLAGS, unparsed = parser.parse_known_args()
+
+    configs = grid(SEARCH_SPACES[FLAGS.model])
+    for params in configs:
+        params.update(batch_size=FLAGS.batch_size, num_epochs=FLAGS.num_epochs, eval_freq=FLAGS.eval_freq)
+
+    start = time.time()
+    trials = search(FLAGS.model, configs, FLAGS.num_workers, FLAGS.threads_per_worker,
+                    None if FLAGS.prune == 'none' else FLAGS.prune, FLAGS.min_evals, FLAGS.eta)
+    path = 'hp_search_' + FLAGS.model + '.csv'
+    write_leaderboard(trials, path)
+    for rank, trial in enumerate(trials):
+        print('%d. NDCG %0.4f%s in %0.1f seconds: %s' % (
+            rank + 1, trial['best_ndcg'], ' (pruned)' if trial['pruned'] else '', trial['time'], trial['params']))
+    print('Searched %d configurations in %0.1f seconds, leaderboard written to %s' % (
+        len(trials), time.time() - start, path))
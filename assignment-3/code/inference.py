@@ -0,0 +1,326 @@
+"""
+Inference for trained rankers: loads a saved Rank_Net, LambdaRank or MLP,
+freezes it and scores candidate lists in chunks, so a trained model can be
+used as a re-ranking stage outside of the training scripts.
+
+The network is rebuilt from its state_dict as a plain stack of linear
+layers, so the training classes (and their data) are not needed to score.
+The backends are:
+    'torchscript': the network traced and frozen with TorchScript,
+    'int8': as 'torchscript', with the weights of the linear layers
+            quantized to int8 and the activations quantized dynamically,
+    'torch': the eager float32 network, the reference for the others,
+    'numpy': the weights as float32 NumPy arrays, for when torch is not
+             wanted at serving time.
+The features can be stored as float16 (see dataset.get_dataset), they are
+converted to float32 one chunk at a time.
+"""
+import re
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    # torch.ao only exists from torch 1.10 on
+    from torch.quantization import quantize_dynamic
+
+import evaluate as evl
+from checkpoint import load_file
+
+BACKENDS = ['torchscript', 'int8', 'torch', 'numpy']
+
+# the prefix of the weights in the state_dict of every model, and whether its output goes through a ReLU
+ARCHITECTURES = OrderedDict([
+    ('rank_net', ('layers.', True)),
+    ('lambda_rank', ('layer', True)),
+    ('mlp', ('linears.', False)),
+    # the nn.Sequential of a Rank_Net saved on its own, like the hyperparameter searches do
+    ('sequential', ('', True)),
+])
+
+_WEIGHT_RE = re.compile(r'^(.*?)(\d+)\.weight$')
+
+
+def to_state_dict(model):
+    """
+    The state_dict of a model, which can be a state_dict, an nn.Module, a LambdaRank
+    (which keeps its network in .model) or a file of checkpoint.Checkpointer.
+    """
+    if isinstance(model, nn.Module):
+        return model.state_dict()
+    if isinstance(getattr(model, 'model', None), nn.Module):
+        return model.model.state_dict()
+    if not isinstance(model, dict):
+        raise TypeError('Expected a state_dict, an nn.Module or a LambdaRank, got %s' % type(model).__name__)
+    if 'format_version' in model and 'model' in model:
+        return model['model']
+    return model
+
+
+def load_state_dict(path):
+    """
+    Loads a checkpoint, which can be a state_dict, a pickled module or LambdaRank or a file of checkpoint.Checkpointer.
+    """
+    return to_state_dict(load_file(path))
+
+
+def linear_layers(state_dict):
+    """
+    Finds the linear layers in the state_dict of one of ARCHITECTURES.
+
+    Returns:
+        list (tensor, tensor): The weight and bias of every layer, in order.
+        bool: Whether the output of the last layer goes through a ReLU.
+    """
+    layers = {}
+    prefixes = set()
+    for key, value in state_dict.items():
+        match = _WEIGHT_RE.match(key)
+        if match is None or value.dim() != 2:
+            continue
+        prefix, index = match.group(1), int(match.group(2))
+        prefixes.add(prefix)
+        layers[index] = (value.detach().float().cpu(), state_dict[key[:-len('weight')] + 'bias'].detach().float().cpu())
+    if len(prefixes) != 1:
+        raise ValueError('Expected the weights of one stack of linear layers, found prefixes %s' % sorted(prefixes))
+    prefix = prefixes.pop()
+    for name, (arch_prefix, final_relu) in ARCHITECTURES.items():
+        if prefix == arch_prefix:
+            break
+    else:
+        raise ValueError('Unknown architecture with weights prefix "%s"' % prefix)
+    layers = [layers[i] for i in sorted(layers)]
+    for (w, _), (w_next, _) in zip(layers, layers[1:]):
+        if w.shape[0] != w_next.shape[1]:
+            raise ValueError('Layers of shape %s and %s do not connect' % (tuple(w.shape), tuple(w_next.shape)))
+    return layers, final_relu
+
+
+def build_network(layers, final_relu):
+    """
+    A frozen nn.Sequential of the linear layers, with a ReLU after all but (possibly) the last.
+    """
+    modules = []
+    for i, (weight, bias) in enumerate(layers):
+        linear = nn.Linear(weight.shape[1], weight.shape[0])
+        linear.weight.data.copy_(weight)
+        linear.bias.data.copy_(bias)
+        modules.append(linear)
+        if i < len(layers) - 1 or final_relu:
+            modules.append(nn.ReLU())
+    network = nn.Sequential(*modules).eval()
+    for p in network.parameters():
+        p.requires_grad_(False)
+    return network
+
+
+class NumpyNetwork(object):
+    """
+    The network as NumPy arrays, scores float32 feature matrices without torch.
+    """
+
+    def __init__(self, layers, final_relu):
+        self.weights = [np.ascontiguousarray(w.numpy().T) for w, _ in layers]
+        self.biases = [b.numpy() for _, b in layers]
+        self.final_relu = final_relu
+
+    def __call__(self, x):
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            x = x @ w
+            x += b
+            if i < len(self.weights) - 1 or self.final_relu:
+                np.maximum(x, 0., out=x)
+        return x[:, 0]
+
+
+class Ranker(object):
+    """
+    Scores and re-ranks documents with a trained network.
+
+    Args:
+        model: A path to a checkpoint, a state_dict, an nn.Module or a LambdaRank of one of ARCHITECTURES.
+        backend (str): One of BACKENDS.
+        chunk_size (int): Number of documents scored at once.
+        num_threads (int): Size of the thread pool that scores the chunks, torch and NumPy
+                           release the GIL in the matrix multiplications.
+    """
+
+    def __init__(self, model, backend='torchscript', chunk_size=4096, num_threads=1):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend: %s' % backend)
+        if isinstance(model, str):
+            model = load_state_dict(model)
+        else:
+            model = to_state_dict(model)
+        layers, final_relu = linear_layers(model)
+        self.num_features = layers[0][0].shape[1]
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.num_threads = num_threads
+
+        if backend == 'numpy':
+            self.network = NumpyNetwork(layers, final_relu)
+        else:
+            network = build_network(layers, final_relu)
+            if backend == 'int8':
+                network = quantize_dynamic(network, {nn.Linear}, dtype=torch.qint8)
+            if backend in ['torchscript', 'int8']:
+                example = torch.zeros(2, self.num_features)
+                with torch.no_grad():
+                    network = torch.jit.freeze(torch.jit.trace(network, example))
+            self.network = network
+        self._pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+
+        self.docs_scored = 0
+        self.seconds = 0.
+
+    def _score_chunk(self, chunk):
+        # copied, the features can be a read-only memory map or float16
+        chunk = np.array(chunk, dtype=np.float32)
+        if self.backend == 'numpy':
+            return self.network(chunk)
+        with torch.no_grad():
+            return self.network(torch.from_numpy(chunk)).reshape(-1).numpy()
+
+    def score(self, features):
+        """
+        Returns the scores of all rows of a (n_docs, num_features) matrix as a float32 array.
+        """
+        if features.ndim != 2 or features.shape[1] != self.num_features:
+            raise ValueError('Expected features of shape (n_docs, %d), got %s' % (self.num_features,
+                                                                                   features.shape))
+        start = time.time()
+        chunks = [features[s_i:s_i + self.chunk_size] for s_i in range(0, features.shape[0], self.chunk_size)]
+        if self._pool is not None and len(chunks) > 1:
+            scores = list(self._pool.map(self._score_chunk, chunks))
+        else:
+            scores = [self._score_chunk(chunk) for chunk in chunks]
+        scores = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+        self.seconds += time.time() - start
+        self.docs_scored += features.shape[0]
+        return scores
+
+    def rerank(self, features, k=None):
+        """
+        Ranks the candidate documents of one query.
+
+        Returns:
+            array int: The indices of the (top k) candidates, best first.
+            array float: Their scores.
+        """
+        scores = self.score(features)
+        if k is not None and k < scores.shape[0]:
+            top = np.argpartition(-scores, k)[:k]
+            order = top[np.argsort(-scores[top], kind='stable')]
+        else:
+            order = np.argsort(-scores, kind='stable')
+        return order, scores[order]
+
+    def score_split(self, data_split):
+        """
+        Scores all documents of a DataFoldSplit, e.g. to pass to evaluate.evaluate.
+        """
+        return self.score(data_split.feature_matrix)
+
+    @property
+    def docs_per_second(self):
+        return self.docs_scored / self.seconds if self.seconds > 0 else 0.
+
+    def save(self, path):
+        """
+        Exports the traced network, which can then be loaded with torch.jit.load without this code.
+        """
+        if self.backend not in ['torchscript', 'int8']:
+            raise ValueError('Only traced networks can be exported, not backend %s' % self.backend)
+        torch.jit.save(self.network, path)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def compare_backends(model, data_split, backends=BACKENDS, chunk_size=4096, num_threads=1, repeat=3,
+                     metrics=('ndcg', 'err')):
+    """
+    Scores the split with every backend and compares them to the float32 network.
+
+    Returns:
+        dict: Per backend the metrics on the split, the difference of the metrics with
+              the 'torch' backend (key metric + '_delta'), the largest absolute difference
+              of the scores with those of the 'torch' backend, the documents scored per
+              second and the speedup in documents per second over the 'torch' backend.
+    """
+    if isinstance(model, str):
+        model = load_state_dict(model)
+    # evaluate breaks ties with random noise, every backend gets the same noise so that
+    # the deltas only show differences in the scores (a final ReLU gives many ties at 0)
+    rng_state = np.random.get_state()
+    results = {}
+    torch_scores = None
+    for backend in ['torch'] + [b for b in backends if b != 'torch']:
+        ranker = Ranker(model, backend, chunk_size, num_threads)
+        # the first pass warms up the thread pool and the traced network
+        scores = ranker.score_split(data_split)
+        ranker.docs_scored, ranker.seconds = 0, 0.
+        for _ in range(repeat):
+            scores = ranker.score_split(data_split)
+        ranker.close()
+        if torch_scores is None:
+            torch_scores = scores
+        np.random.set_state(rng_state)
+        result = evl.evaluate(data_split, scores, metrics=metrics)
+        results[backend] = {k: v[0] for k, v in result.items()}
+        results[backend]['max_score_diff'] = float(np.amax(np.abs(scores - torch_scores), initial=0.))
+        results[backend]['docs_per_second'] = ranker.docs_per_second
+        for k in metrics:
+            results[backend][k + '_delta'] = results[backend][k] - results['torch'][k]
+        results[backend]['speedup'] = ranker.docs_per_second / results['torch']['docs_per_second']
+    return results
+
+
+if __name__ == '__main__':
+    import dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help='Saved state_dict or module of a Rank_Net, LambdaRank or MLP')
+    parser.add_argument('--backend', choices=BACKENDS, default='torchscript')
+    parser.add_argument('--split', choices=['train', 'validation', 'test'], default='test')
+    parser.add_argument('--chunk_size', type=int, default=4096)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times the split is scored')
+    parser.add_argument('--feature_dtype', choices=['float32', 'float16'], default='float32',
+                        help='Type the features are stored as')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare the metrics and speed of all backends to the float32 network')
+    parser.add_argument('--export', type=str, default=None, help='Path to save the traced network to')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    data = dataset.get_dataset(feature_dtype=FLAGS.feature_dtype).get_data_folds()[0]
+    data.read_data()
+    data_split = getattr(data, FLAGS.split)
+
+    if FLAGS.compare:
+        results = compare_backends(FLAGS.checkpoint, data_split, BACKENDS, FLAGS.chunk_size, FLAGS.num_threads,
+                                   FLAGS.repeat)
+        for backend, r in results.items():
+            print('%s: NDCG %0.4f (%+0.5f), ERR %0.4f (%+0.5f), max score difference %0.2e, '
+                  '%d documents per second (%0.2fx)' % (backend, r['ndcg'], r['ndcg_delta'], r['err'], r['err_delta'],
+                                                         r['max_score_diff'], r['docs_per_second'], r['speedup']))
+    else:
+        ranker = Ranker(FLAGS.checkpoint, FLAGS.backend, FLAGS.chunk_size, FLAGS.num_threads)
+        for _ in range(FLAGS.repeat):
+            scores = ranker.score_split(data_split)
+        ranker.close()
+        if FLAGS.export is not None:
+            ranker.save(FLAGS.export)
+        evl.evaluate(data_split, scores, print_results=True, metrics=['ndcg', 'err'])
+        print('Scored %d documents in %0.2f seconds, %d documents per second' % (
+            ranker.docs_scored, ranker.seconds, ranker.docs_per_second))
@@ -1,4 +1,6 @@
 import dataset
+import delta_metrics
+import pairwise
 import ranking as rnk
 import tqdm
 import evaluate as evl
@@ -6,24 +8,16 @@ import numpy as np
 import torch
 import pickle
 
+from monitor import ValidationMonitor
+from checkpoint import resume_run
+from profiling import StepProfiler
+
 from collections import OrderedDict
 from torch import nn
 
 
-def delta_irm(irm, labels, scores, i, j, query_dcg=None):
-    # sort labels by ranking score
-    sorted_idx = (-scores).argsort()
-    sorted_labels = labels[sorted_idx]
-    # keep track of where i and j where sorted to
-    new_idx_i = np.argwhere(sorted_idx == i)[0][0]
-    new_idx_j = np.argwhere(sorted_idx == j)[0][0]
-    # compute irm once before and once after swapping
-    before = irm(sorted_labels, 0, query_dcg)
-    sorted_labels[new_idx_i], sorted_labels[new_idx_j] = sorted_labels[new_idx_j], sorted_labels[new_idx_i]
-    after = irm(sorted_labels, 0, query_dcg)
-
-    return abs(before - after)
-
+# the delta metric that belongs to each of the irm functions of evaluate.py
+DELTA_METRICS = {evl.ndcg_speed: 'ndcg', evl.err: 'err', evl.err_rank_net: 'err'}
 
 
 class LambdaRank:
@@ -43,120 +37,126 @@ class LambdaRank:
         self.model = nn.Sequential(layers)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    def train(self, data, irm=evl.ndcg_speed, lr=1e-4, sigma=1):
+    def train(self, data, irm=evl.ndcg_speed, lr=1e-4, sigma=1, num_epochs=1, batch_size=1, streaming=False,
+              callback=None, top_k=None, num_samples=None, checkpoint_dir=None, trace_dir=None, eval_freq=100):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model = self.model.to(device)
-        # more epochs take soooo long
-        num_epochs = 1
-        evaluate_every = 100
+        # irm can be one of the functions of evaluate.py or 'ndcg'/'err'
+        metric = DELTA_METRICS.get(irm, irm)
+        # with top_k only the pairs with a document in the current top k are used (optionally num_samples of them
+        # per top document), which bounds the work per query to top_k * n_docs (or top_k * num_samples)
+        # evaluate on the validation set every eval_freq queries
+        evaluate_every = eval_freq
         optimizer = torch.optim.Adam(self.model.parameters(), lr=lr)
         # variables for early stopping
         max_iterations = 500 # maximum number of iterations the model's performance is allowed to not increase
-        best_model = None
-        best_model_irm = 0
+        # validation features are converted to a tensor once, only ndcg and err are computed
+        validation = ValidationMonitor(data.validation, metric='ndcg', metrics=['ndcg', 'err'], device=device,
+                                       in_memory=not streaming, callback=callback)
         since_last_improvement = 0 # how many iterations have passed since last increase in performance
         stopped = False
         # variables to track ndcg and err development over training
         config_ndcgs = []
         errs = []
 
-        for n in range(num_epochs):
-            # goes sequentially through dataset, not batched
-            for idx in tqdm.tqdm(range(data.train.num_queries())):
+        # queries with a single document have no pairs, a single epoch visits the queries in their original order
+        loader = dataset.query_loader(data.train, batch_size, shuffle=num_epochs > 1, min_docs=2, device=device,
+                                      streaming=streaming)
+        start_epoch, start_done = 0, 0
+        # the convergence counter is checkpointed too, as it is kept here and not by the monitor
+        checkpointer, state = resume_run(checkpoint_dir, self.model, optimizer, loader, validation)
+        if state is not None:
+            extra = state['extra']
+            start_epoch, start_done, stopped = extra['epoch'], extra['queries_done'], extra['stopped']
+            config_ndcgs, errs = extra['ndcgs'], extra['errs']
+            since_last_improvement = extra['since_last_improvement']
+        # computing the lambdas is timed apart from the forward and backward pass, it dominates for long queries
+        self.profiler = StepProfiler(device, trace_dir, data.train)
+        for n in range(start_epoch, num_epochs):
+            if stopped:
+                break
+            queries_done = start_done if n == start_epoch else 0
+            for features, labels, mask, query_indices in tqdm.tqdm(self.profiler.iterate(loader), total=len(loader)):
                 self.model.zero_grad()
-                # get feature vectors and labels for each query
-                features = data.train.query_feat(idx)
-                labels_numpy = data.train.query_labels(idx)
-                features = torch.tensor(features).float().to(device)
-                labels = torch.tensor(labels_numpy).float().to(device)
-                # compute scores
-                s = self.model(features)
-                # make matrix of scores with all combinations with itself
-                scores_repeated = s.repeat(1, s.shape[0])
-                scores_repeated_t = s.t().repeat(s.shape[0], 1)
-                # compute all differences s_i-s_j
-                difference = scores_repeated - scores_repeated_t
-                # do the same for the labels
-                labels_repeated = labels.unsqueeze(1).repeat(1, s.shape[0])
-                labels_repeated_t = labels.unsqueeze(0).repeat(s.shape, 1)
-                labels_difference = labels_repeated - labels_repeated_t
-                ones = torch.ones_like(labels_difference)
-                zeros = torch.zeros_like(labels_difference)
-                # use torch.where to get a matrix of S_ij
-                s_ij = torch.where(labels_difference > 0, ones, -ones)
-                s_ij = torch.where(labels_difference == 0, zeros, s_ij)
-                # plug everything into the formula to compute the lambdas
-                lambdas = sigma*(0.5*(torch.ones_like(s_ij)-s_ij)-(1 / (1 + torch.exp(sigma * difference))))
-                deltas = torch.zeros_like(lambdas, requires_grad=False)
-                # calculate the perfect dcg of the query here once to save time
-                sorted_labels, _ = labels.sort(descending=True)
-                query_dcg = evl.dcg_at_k(sorted_labels.cpu().numpy(), 0)
-                s_detached = s.detach().squeeze().cpu().numpy()
-                # calculate the change in ndcg/err for each combination i,j
-                for i in range(lambdas.shape[0]):
-                    for j in range(i + 1, lambdas.shape[1]):
-                        deltas[i, j] = delta_irm(irm, labels_numpy, s_detached, i, j, query_dcg)
-                        deltas[j, i] = deltas[i, j]
-                # scale gradients by deltas
-                lambdas = lambdas * deltas
-                lambdas = lambdas.sum(1)
+                # compute scores, (batch, max_docs)
+                with self.profiler.phase('forward'):
+                    s = self.model(features).squeeze(-1)
+                s_detached = s.detach()
+                with self.profiler.phase('lambda'):
+                    # the ideal dcg of every query is precomputed by the split
+                    query_dcg = torch.from_numpy(data.train.ideal_dcg[query_indices, 0]).float().to(device)
+                    if top_k is None:
+                        # lambda_ij of RankNet, scaled by the change in ndcg/err of swapping i and j
+                        lambdas = pairwise.rank_net_lambda_matrix(s_detached, labels, sigma, mask)
+                        deltas = delta_metrics.lambda_weights(s_detached, labels, mask, metric, query_dcg)
+                        lambdas = torch.sum(lambdas * deltas, dim=-1)
+                    else:
+                        lambdas = delta_metrics.truncated_lambdas(s_detached, labels, sigma, mask, metric,
+                                                                  query_dcg, top_k, num_samples)
                 # update weights
-                s.backward(lambdas.unsqueeze(1))
-                optimizer.step()
+                with self.profiler.phase('backward'):
+                    s.backward(lambdas)
+                    optimizer.step()
+                self.profiler.step_queries(query_indices)
 
+                idx = queries_done
+                queries_done += features.shape[0]
                 # check the model's performance on validation set
-                if idx % evaluate_every == 0:
-                    result = self.eval_model()
+                if idx // evaluate_every != queries_done // evaluate_every or idx == 0:
+                    with self.profiler.phase('eval'):
+                        validation.step(self.model, step=(n, queries_done))
+                    result = validation.last_results
                     ndcg = result['ndcg'][0]
                     err = result['err'][0]
                     config_ndcgs.append(ndcg)
                     errs.append(err)
 
-                    # check for early stopping
-                    if ndcg < best_model_irm:
-                        since_last_improvement += evaluate_every
+                    # the callback can end training, e.g. during a hyperparameter search
+                    if validation.stopped:
+                        stopped = True
+                    # check for early stopping, the monitor keeps a copy of the best model
+                    elif not validation.improved:
+                        since_last_improvement += max(evaluate_every, features.shape[0])
                         if since_last_improvement > max_iterations:
                             stopped = True
                             print("Reached Convergence!!!!!!!")
-                            break
                     else:
                         since_last_improvement = 0
-                        best_model = self.model.state_dict()
-                        best_model_irm = ndcg
+                    if checkpointer is not None:
+                        with self.profiler.phase('checkpoint'):
+                            checkpointer.save_evaluation((n, queries_done), self.model, optimizer, loader, validation, {
+                                'epoch': n, 'queries_done': queries_done, 'stopped': stopped, 'ndcgs': config_ndcgs,
+                                'errs': errs, 'since_last_improvement': since_last_improvement})
+                    if stopped:
+                        break
             if stopped:
                 break
-        # after training, eval onece more on validation AND on test set
-        self.eval_model()
+        self.profiler.finish()
+        best_model = validation.best_state
+        best_model_irm = validation.best_value
         torch.save(best_model, './best_lambda_rank_'+self.name)
         # final test set evaluation
-        with torch.no_grad():
-            features = data.test.feature_matrix
-            features = torch.tensor(features).float().to(self.device)
-            test_s = self.model(features)
-        results = evl.evaluate(data.test, test_s.cpu().numpy().squeeze(), print_results=True)
+        results = self.eval_model(data.test, print_results=True, in_memory=not streaming)
         return best_model, best_model_irm, config_ndcgs, errs
 
-    def eval_model(self):
-        with torch.no_grad():
-            features = data.validation.feature_matrix
-            features = torch.tensor(features).float().to(self.device)
-            validation_s = self.model(features)
-            results = evl.evaluate(data.validation, validation_s.cpu().numpy().squeeze())
-            return results
+    def eval_model(self, data_split, print_results=False, in_memory=True):
+        return ValidationMonitor(data_split, device=self.device, in_memory=in_memory).evaluate(
+            self.model, print_results=print_results)
 
 
 def hyperparameter_search():
     lrs = [1e-4, 1e-5, 1e-6]
     hidden_layers = [[200, 100], [200,100,50]]
     irm = evl.ndcg_speed
+    sigma = 1
     best_ndcg = 0
     best_model = None
     ndcgs = []
 
     for lr in lrs:
         for hidden_layer in hidden_layers:
-            model = LambdaRank(hidden_layer, data.num_features, lr)
-            model, model_best_ndcg, model_ndcgs, model_best_err = model.train(data, irm, lr)
+            model = LambdaRank(hidden_layer, data.num_features, lr, sigma)
+            model, model_best_ndcg, model_ndcgs, model_best_err = model.train(data, irm, lr, sigma)
             ndcgs.append(model_ndcgs)
             print(model_best_ndcg)
             if model_best_ndcg > best_ndcg:
@@ -0,0 +1,88 @@
+"""
+Listwise losses computed on whole queries at once: the ListNet softmax
+cross-entropy and ApproxNDCG, a differentiable approximation of NDCG.
+
+As in pairwise.py, the functions accept scores and labels of shape
+(n_docs,) for a single query or (n_queries, max_docs) for a padded batch
+of queries, in which case `mask` marks the real documents. The losses are
+summed over the queries.
+"""
+import torch
+import torch.nn.functional as F
+
+import delta_metrics
+
+
+def list_net_loss(scores, labels, mask=None):
+  """
+  The ListNet loss with top one probabilities: the cross-entropy between
+  the softmax of the labels and the softmax of the scores of a query.
+
+  Args:
+      scores (tensor float): Scores of the documents.
+      labels (tensor float): Relevance labels of the documents.
+      mask (tensor bool): Which documents are real (not padding), optional.
+
+  Returns:
+      tensor float: The loss summed over the queries.
+  """
+  if mask is not None:
+    # padding gets zero probability in both distributions
+    scores = scores.masked_fill(~mask, float('-inf'))
+    labels = labels.masked_fill(~mask, float('-inf'))
+  target = F.softmax(labels, dim=-1)
+  log_p = F.log_softmax(scores, dim=-1)
+  # 0 * -inf is nan, so padding is left out explicitly
+  return -torch.sum(torch.where(target > 0, target * log_p, torch.zeros_like(log_p)))
+
+
+def approx_ranks(scores, mask=None, temperature=1.0):
+  """
+  The smooth (1-based) rank of every document: 1 + sum_j sigmoid((s_j - s_i) / temperature)
+  over all other documents j of the query.
+  """
+  score_diff = (scores.unsqueeze(-2) - scores.unsqueeze(-1)) / temperature
+  above = torch.sigmoid(score_diff)
+  if mask is not None:
+    above = above * mask.unsqueeze(-2)
+  # the document itself adds sigmoid(0) = 0.5
+  return 0.5 + torch.sum(above, dim=-1)
+
+
+def approx_ndcg(scores, labels, mask=None, temperature=1.0, query_dcg=None):
+  """
+  The NDCG of every query with the ranks replaced by approx_ranks, which
+  tends to the true NDCG as the temperature goes to zero.
+
+  Args:
+      scores (tensor float): Scores of the documents.
+      labels (tensor float): Relevance labels of the documents.
+      mask (tensor bool): Which documents are real (not padding), optional.
+      temperature (float): Smoothness of the ranks.
+      query_dcg (tensor float): The ideal DCG of the query (one per query),
+                                computed from the labels if not given.
+
+  Returns:
+      tensor float: The approximate NDCG, shape (...).
+  """
+  if mask is not None:
+    labels = labels * mask
+  if query_dcg is None:
+    query_dcg = delta_metrics.ideal_dcg(labels)
+  ranks = approx_ranks(scores, mask, temperature)
+  dcg = torch.sum((2 ** labels - 1.) / torch.log2(ranks + 1.), dim=-1)
+  # same smoothing as evaluate.ndcg_speed
+  return dcg / (query_dcg + 1e-8)
+
+
+def approx_ndcg_loss(scores, labels, mask=None, temperature=1.0, query_dcg=None):
+  """
+  The negative ApproxNDCG summed over the queries.
+  """
+  return -torch.sum(approx_ndcg(scores, labels, mask, temperature, query_dcg))
+
+
+LOSSES = {
+  'list_net': list_net_loss,
+  'approx_ndcg': approx_ndcg_loss,
+}
@@ -0,0 +1,143 @@
+"""
+Validation monitoring for the trainers: scores a split in chunks with tensors
+that are built once, and keeps track of the best model for early stopping.
+"""
+import numpy as np
+import torch
+
+import evaluate as evl
+
+# torch.inference_mode is only available from torch 1.9 on
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+class ValidationMonitor(object):
+    """
+    Evaluates a model on a fixed data split during training.
+
+    The features and labels of the split are converted to tensors on the
+    device once. Every call to step() scores the split in chunks, computes
+    only the metrics needed for early stopping and keeps a copy of the
+    state_dict of the best model so far.
+
+    Args:
+        data_split (DataFoldSplit): The split to evaluate on, usually data.validation.
+        metric (str): The metric that decides which model is best, higher is better.
+        metrics (list str): The metrics computed at every step, defaults to [metric].
+        patience (int): Stop after this many steps without improvement, None to never stop.
+        device: The device the model is on.
+        chunk_size (int): Number of documents scored at once.
+        in_memory (bool): Keep the features as a tensor on the device, if False the chunks are
+                          read from the split on every evaluation, for splits that do not fit in memory.
+        callback (function): Called as callback(step, value, results) after every step,
+                             training stops if it returns True.
+    """
+
+    def __init__(self, data_split, metric='ndcg', metrics=None, patience=None, device='cpu',
+                 chunk_size=65536, in_memory=True, callback=None):
+        self.data_split = data_split
+        self.metric = metric
+        self.metrics = metrics if metrics is not None else [metric]
+        if metric not in self.metrics:
+            self.metrics = self.metrics + [metric]
+        self.patience = patience
+        self.device = device
+        self.chunk_size = chunk_size
+        self.callback = callback
+
+        self.in_memory = in_memory
+
+        labels = torch.from_numpy(np.ascontiguousarray(data_split.label_vector, dtype=np.float32))
+        if in_memory:
+            # copied, the feature matrix can be a read-only memory map
+            features = torch.from_numpy(np.array(data_split.feature_matrix, dtype=np.float32))
+        if torch.device(device).type == 'cuda':
+            labels = labels.pin_memory()
+            if in_memory:
+                features = features.pin_memory()
+        self.labels = labels.to(device)
+        self.features = features.to(device) if in_memory else None
+
+        self.best_value = -np.inf
+        self.best_step = None
+        self.best_state = None
+        self.improved = False
+        self.bad_steps = 0
+        self.stopped = False
+        self.history = []
+        self.last_scores = None
+        self.last_results = None
+
+    def score(self, model):
+        """
+        Returns the scores of all documents in the split as a tensor on the device.
+        """
+        was_training = model.training
+        model.eval()
+        with _inference_mode():
+            scores = torch.cat([model(chunk).reshape(-1) for chunk in self._chunks()])
+        model.train(was_training)
+        return scores
+
+    def _chunks(self):
+        if self.in_memory:
+            for chunk in torch.split(self.features, self.chunk_size):
+                yield chunk
+            return
+        feature_matrix = self.data_split.feature_matrix
+        for s_i in range(0, feature_matrix.shape[0], self.chunk_size):
+            chunk = np.array(feature_matrix[s_i:s_i + self.chunk_size], dtype=np.float32)
+            yield torch.from_numpy(chunk).to(self.device)
+
+    def evaluate(self, model, metrics=None, print_results=False):
+        """
+        Evaluates the model on the split, with all metrics unless metrics is given.
+        """
+        scores = self.score(model).cpu().numpy()
+        return evl.evaluate(self.data_split, scores, print_results=print_results, metrics=metrics)
+
+    def step(self, model, step=None):
+        """
+        Evaluates the model, updates the best state and returns whether training should stop.
+        """
+        self.last_scores = self.score(model)
+        self.last_results = evl.evaluate(self.data_split, self.last_scores.cpu().numpy(), metrics=self.metrics)
+        value = self.last_results[self.metric][0]
+        self.history.append(value)
+
+        self.improved = value > self.best_value
+        if self.improved:
+            self.best_value = value
+            self.best_step = step
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            self.bad_steps = 0
+        else:
+            self.bad_steps += 1
+
+        if self.patience is not None and self.bad_steps >= self.patience:
+            self.stopped = True
+        if self.callback is not None and self.callback(step, value, self.last_results):
+            self.stopped = True
+        return self.stopped
+
+    def state_dict(self):
+        return {'best_value': self.best_value, 'best_step': self.best_step, 'best_state': self.best_state,
+                'bad_steps': self.bad_steps, 'history': list(self.history), 'improved': self.improved,
+                'stopped': self.stopped}
+
+    def load_state_dict(self, state):
+        self.best_value = state['best_value']
+        self.best_step = state['best_step']
+        self.best_state = state['best_state']
+        if self.best_state is not None:
+            self.best_state = {k: v.to(self.device) for k, v in self.best_state.items()}
+        self.bad_steps = state['bad_steps']
+        self.history = list(state['history'])
+        # not in the checkpoints written before early stopping was saved
+        self.improved = state.get('improved', False)
+        self.stopped = state.get('stopped', False)
+
+    def restore_best(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+        return model
@@ -0,0 +1,67 @@
+"""
+Pairwise quantities for RankNet and LambdaRank, computed by broadcasting
+over whole queries instead of enumerating document pairs.
+
+All functions accept scores and labels of shape (n_docs,) for a single
+query or (n_queries, max_docs) for a padded batch of queries, in which
+case `mask` marks the real documents.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def pair_matrices(scores, labels, mask=None):
+  """
+  Computes the pairwise score differences and preferences of a query.
+
+  Args:
+      scores (tensor float): Scores of the documents.
+      labels (tensor float): Relevance labels of the documents.
+      mask (tensor bool): Which documents are real (not padding), optional.
+
+  Returns:
+      tensor float: s_i - s_j for every pair, shape (..., n_docs, n_docs).
+      tensor float: S_ij, 1 if i is more relevant than j, -1 if less, 0 for ties.
+      tensor bool: Which pairs count, i.e. pairs of real documents
+                   with different labels.
+  """
+  score_diff = scores.unsqueeze(-1) - scores.unsqueeze(-2)
+  S_ij = torch.sign(labels.unsqueeze(-1) - labels.unsqueeze(-2))
+  valid = S_ij != 0
+  if mask is not None:
+    valid = valid & mask.unsqueeze(-1) & mask.unsqueeze(-2)
+  return score_diff, S_ij, valid
+
+
+def rank_net_loss(scores, labels, sigma=1.0, mask=None):
+  """
+  The RankNet cross-entropy loss summed over all valid pairs.
+  """
+  score_diff, S_ij, valid = pair_matrices(scores, labels, mask)
+  sig_diff = sigma * score_diff
+  # 0.5 * (1 - S_ij) * sig_diff + log(1 + exp(-sig_diff)), with a stable softplus
+  C = 0.5 * (1 - S_ij) * sig_diff + F.softplus(-sig_diff)
+  return torch.sum(C * valid)
+
+
+def lambda_ij(score_diff, S_ij, sigma=1.0):
+  """
+  The RankNet lambda of pairs from their score differences s_i - s_j and preferences S_ij.
+  """
+  return sigma * (0.5 * (1 - S_ij) - torch.sigmoid(-sigma * score_diff))
+
+
+def rank_net_lambda_matrix(scores, labels, sigma=1.0, mask=None):
+  """
+  The lambda_ij of every pair, zero for pairs that do not count.
+  """
+  score_diff, S_ij, valid = pair_matrices(scores, labels, mask)
+  return lambda_ij(score_diff, S_ij, sigma) * valid
+
+
+def rank_net_lambdas(scores, labels, sigma=1.0, mask=None):
+  """
+  The lambda of every document, i.e. the sum of its lambda_ij over all j,
+  which is used as the gradient of the document's score.
+  """
+  return torch.sum(rank_net_lambda_matrix(scores, labels, sigma, mask), dim=-1)
@@ -38,37 +38,37 @@ def plot_err():
     model1 = LambdaRank([200,100], 501, 1e-4, 1)
     model1.model.load_state_dict(torch.load('best_lambda_rank_0.0001[200, 100]501'))
     model1.model.eval()
-    results = model1.eval_model()
+    results = model1.eval_model(data.validation)
     errs.append(results['err'][0])
 
     model2 = LambdaRank([200, 100, 50], 501, 1e-4, 1)
     model2.model.load_state_dict(torch.load('best_lambda_rank_0.0001[200, 100, 50]501'))
     model2.model.eval()
-    results = model2.eval_model()
+    results = model2.eval_model(data.validation)
     errs.append(results['err'][0])
 
     model3 = LambdaRank([200, 100], 501, 1e-5, 1)
     model3.model.load_state_dict(torch.load('best_lambda_rank_1e-05[200, 100]501'))
     model3.model.eval()
-    results = model3.eval_model()
+    results = model3.eval_model(data.validation)
     errs.append(results['err'][0])
 
     model4 = LambdaRank([200, 100, 50], 501, 1e-5, 1)
     model4.model.load_state_dict(torch.load('best_lambda_rank_1e-05[200, 100, 50]501'))
     model4.model.eval()
-    results = model4.eval_model()
+    results = model4.eval_model(data.validation)
     errs.append(results['err'][0])
 
     model5 = LambdaRank([200, 100], 501, 1e-6, 1)
     model5.model.load_state_dict(torch.load('best_lambda_rank_1e-06[200, 100]501'))
     model5.model.eval()
-    results = model5.eval_model()
+    results = model5.eval_model(data.validation)
     errs.append(results['err'][0])
 
     model6 = LambdaRank([200, 100, 50], 501, 1e-6, 1)
     model6.model.load_state_dict(torch.load('best_lambda_rank_1e-06[200, 100, 50]501'))
     model6.model.eval()
-    results = model6.eval_model()
+    results = model6.eval_model(data.validation)
     errs.append(results['err'][0])
     print(errs)
     plt.figure()
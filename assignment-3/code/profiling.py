@@ -0,0 +1,183 @@
+"""
+Per-step instrumentation for the trainers: the time spent in every phase of
+a training step and the throughput in queries, document pairs and documents
+per second, optionally with a torch.profiler trace written to disk.
+
+The phases of a step are
+    'data': preparing the batch, i.e. waiting for the loader,
+    'forward': scoring the documents,
+    'lambda': the lambdas of LambdaRank and sped-up RankNet, or the loss,
+    'backward': backpropagation and the optimizer step,
+    'eval': evaluation on the validation set,
+    'checkpoint': writing checkpoints.
+Time outside of all phases is reported as 'other'.
+
+Timing a phase only reads the clock. CUDA work is asynchronous though, so the
+phases are only synchronized with the GPU when profiling is requested with a
+trace directory (or sync=True); otherwise GPU time shows up in the phase that
+waits for it. The documents and pairs of a step are counted from the query
+sizes and labels of the split, without touching the batch tensors.
+"""
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+PHASES = ('data', 'forward', 'lambda', 'backward', 'eval', 'checkpoint')
+# phases that are not part of training itself, left out of the throughput
+_NON_TRAINING_PHASES = ('eval', 'checkpoint')
+
+
+def query_pairs(data_split):
+    """
+    Number of document pairs with different labels of every query in the split,
+    the pairs RankNet and LambdaRank learn from.
+    """
+    sizes = data_split.query_sizes()
+    labels = np.asarray(data_split.label_vector, dtype=np.int64)
+    doc_query = np.repeat(np.arange(sizes.shape[0]), sizes)
+    # documents per (query, label), all pairs minus the pairs within every label value
+    num_labels = np.amax(labels, initial=0) + 1
+    keys, counts = np.unique(doc_query * num_labels + labels, return_counts=True)
+    same_label = np.zeros(sizes.shape[0], dtype=np.int64)
+    np.add.at(same_label, keys // num_labels, counts.astype(np.int64) ** 2)
+    return (sizes.astype(np.int64) ** 2 - same_label) // 2
+
+
+class StepProfiler(object):
+    """
+    Accumulates the time of the phases of training steps.
+
+    Args:
+        device: The device training runs on.
+        trace_dir (str): If given, a torch.profiler trace of a few steps is written to this
+                         directory, which can be opened with TensorBoard or chrome://tracing.
+        data_split (DataFoldSplit): The split that is trained on, needed for step_queries().
+        sync (bool): Synchronize CUDA at the end of every phase so that GPU work is counted
+                     in the right phase, by default only when a trace is written.
+        trace_wait (int): Number of steps before the trace starts.
+        trace_steps (int): Number of steps that are traced.
+    """
+
+    def __init__(self, device='cpu', trace_dir=None, data_split=None, sync=None, trace_wait=5, trace_steps=5):
+        cuda = torch.device(device).type == 'cuda'
+        self.sync = cuda and (sync if sync is not None else trace_dir is not None)
+        self.data_split = data_split
+        self._query_sizes = data_split.query_sizes() if data_split is not None else None
+        self._query_pairs = query_pairs(data_split) if data_split is not None else None
+        self.times = OrderedDict((phase, 0.) for phase in PHASES)
+        self.num_steps = 0
+        self.num_queries = 0
+        self.num_pairs = 0
+        self.num_docs = 0
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+        self.trace_dir = trace_dir
+        self._profiler = None
+        if trace_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=trace_wait, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir))
+            self._profiler.start()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager that adds the time of its block to the phase.
+        """
+        start = time.perf_counter()
+        if self._profiler is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.times[name] = self.times.get(name, 0.) + time.perf_counter() - start
+
+    def iterate(self, loader):
+        """
+        Iterates over the loader, with the time spent waiting for every batch counted as 'data'.
+        """
+        iterator = iter(loader)
+        while True:
+            with self.phase('data'):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self, num_queries=0, num_pairs=0, num_docs=0):
+        """
+        Marks the end of a training step on num_queries queries.
+        """
+        self.num_steps += 1
+        self.num_queries += num_queries
+        self.num_pairs += num_pairs
+        self.num_docs += num_docs
+        self.end_time = time.perf_counter()
+        if self._profiler is not None:
+            self._profiler.step()
+
+    def step_queries(self, query_indices):
+        """
+        Marks the end of a training step on the queries of data_split with the given indices.
+        """
+        self.step(len(query_indices), int(np.sum(self._query_pairs[query_indices])),
+                  int(np.sum(self._query_sizes[query_indices])))
+
+    def close(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+            print('Profiler trace written to {}'.format(self.trace_dir))
+
+    def finish(self):
+        """
+        Stops the trace and prints and returns the summary, at the end of training.
+        """
+        self.close()
+        return self.print_summary()
+
+    def summary(self):
+        """
+        Returns:
+            dict: The seconds spent in every phase ('other' for time outside the phases),
+                  the total seconds, the seconds of training itself (without evaluation
+                  and checkpoints) and the queries, pairs and documents per second of training.
+        """
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        total = end_time - self.start_time
+        times = OrderedDict(self.times)
+        times['other'] = max(0., total - sum(self.times.values()))
+        train_seconds = total - sum(times.get(phase, 0.) for phase in _NON_TRAINING_PHASES)
+        per_second = lambda n: n / train_seconds if train_seconds > 0 else 0.
+        return {
+            'times': times,
+            'seconds': total,
+            'train_seconds': train_seconds,
+            'steps': self.num_steps,
+            'queries_per_second': per_second(self.num_queries),
+            'pairs_per_second': per_second(self.num_pairs),
+            'docs_per_second': per_second(self.num_docs),
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        # pointwise training has no queries or pairs
+        rates = ['{:.1f} {}/s'.format(summary[name + '_per_second'], name)
+                 for name in ['queries', 'pairs', 'docs'] if summary[name + '_per_second'] > 0]
+        print('{} steps in {:.1f} seconds{}'.format(summary['steps'], summary['seconds'],
+                                                    ''.join(', ' + rate for rate in rates)))
+        for phase, seconds in summary['times'].items():
+            if seconds > 0:
+                print('    {:<10} {:8.2f} s {:6.1%}'.format(phase, seconds, seconds / max(summary['seconds'], 1e-12)))
+        return summary
@@ -1,16 +1,19 @@
 import dataset
 import evaluate as evl
 
-import math
 import torch
 import torch.nn as nn
 import numpy as np
 from tqdm import tqdm
 from time import time
-from itertools import product
 
 import pickle
 
+import pairwise
+from monitor import ValidationMonitor
+from checkpoint import resume_run
+from profiling import StepProfiler
+
 
 class Rank_Net(nn.Module):
     def __init__(self, d_in, num_neurons=[200, 100], sigma=1.0, dropout=0.0, device='cpu', model_id=None):
@@ -33,175 +36,114 @@ class Rank_Net(nn.Module):
             layers.append(nn.Linear(h, h_next))
             #layers.append(nn.Dropout(self.dropout))
             layers.append(nn.ReLU())
-        self.layers = nn.Sequential(*layers)
+        self.layers = nn.Sequential(*layers).to(self.device)
 
     def forward(self, x):
-        x = torch.Tensor(x).to(self.device)
-        self.layers.to(self.device)
+        # only arrays are converted, tensors are assumed to be on the device already
+        if not torch.is_tensor(x):
+            x = torch.as_tensor(np.array(x, dtype=np.float32), device=self.device)
         return self.layers(x)
 
-    def train_bgd(self, data, lr=5e-4, batch_size=500, num_epochs=1, eval_freq=1000):
-        self.layers.train()
+    def train_bgd(self, data, lr=5e-4, batch_size=500, num_epochs=1, eval_freq=1000, streaming=False, callback=None,
+                  checkpoint_dir=None, trace_dir=None):
+        return self._train(data, lr, batch_size, num_epochs, eval_freq, streaming, callback, checkpoint_dir,
+                           trace_dir)
+
+    def train_sgd(self, data, lr=1e-5, num_epochs=1, eval_freq=1000, streaming=False, callback=None,
+                  checkpoint_dir=None, trace_dir=None):
+        return self._train(data, lr, 1, num_epochs, eval_freq, streaming, callback, checkpoint_dir, trace_dir)
+
+    def _train(self, data, lr, batch_size, num_epochs, eval_freq, streaming=False, callback=None, checkpoint_dir=None,
+               trace_dir=None):
         optimizer = torch.optim.Adam(self.layers.parameters(), lr=lr)
-        num_queries = data.train.num_queries()
+        # queries with less than two documents are skipped, as no loss can be computed if there is no document pair
+        loader = dataset.query_loader(data.train, batch_size=batch_size, shuffle=True, min_docs=2,
+                                      device=self.device, streaming=streaming)
+        num_queries = int(np.sum(data.train.query_sizes() >= 2))
+        # stop after 8 evaluations without an improvement of the validation NDCG
+        validation = ValidationMonitor(data.validation, metric='ndcg', metrics=['ndcg', 'arr'], patience=8,
+                                       device=self.device, in_memory=not streaming, callback=callback)
         validation_results = []
         losses = []
         arrs = []
-        best_ndcg = 0
-        no_improvement = 0
         converged = False
-        for e in range(num_epochs):
+        start_epoch, start_done = 0, 0
+        # a resumed run continues in the epoch and at the query it was checkpointed, with the losses so far
+        checkpointer, state = resume_run(checkpoint_dir, self.layers, optimizer, loader, validation)
+        if state is not None:
+            extra = state['extra']
+            start_epoch, start_done, converged = extra['epoch'], extra['queries_done'], extra['converged']
+            validation_results, losses, arrs = extra['validation_results'], extra['losses'], extra['arrs']
+        # _step times the loss (or lambdas) and the update of both RankNet variants
+        self.profiler = StepProfiler(self.device, trace_dir, data.train)
+        for e in range(start_epoch, num_epochs):
             if converged:
                 break
-            random_query_order = np.arange(num_queries)
-            np.random.shuffle(random_query_order)
-            all_loss = 0
-            for qid in tqdm(range(num_queries)):
-                x = torch.Tensor(data.train.query_feat(random_query_order[qid])).to(self.device)
-                query_scores = self.layers(x)
-                query_labels = data.train.query_labels(random_query_order[qid])
-
-
-                # to catch cases with less than two documents (as no loss can be computed if there is no document pair)
-                if len(query_labels) < 2:
-                    continue
-
-                score_combs = list(zip(*product(query_scores, repeat=2)))
-                score_combs_i = torch.stack(score_combs[0]).squeeze()
-                score_combs_j = torch.stack(score_combs[1]).squeeze()
-
-                label_combs = np.array(list(product(query_labels, repeat=2)))
-                label_combs_i = torch.from_numpy(label_combs[:, 0])
-                label_combs_j = torch.from_numpy(label_combs[:, 1])
-
-                loss = self.rank_net_loss(score_combs_i, score_combs_j,
-                                                            label_combs_i, label_combs_j)
-
-                all_loss += loss
-                losses.append(loss.item()/(batch_size if qid % batch_size == 0 else num_queries % batch_size))
-
-                if qid % batch_size == 0 or qid == num_queries-1:
-                    all_loss /= (batch_size if qid % batch_size == 0 else num_queries % batch_size)
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-
+            queries_done = start_done if e == start_epoch else 0
+            for features, labels, mask, query_indices in tqdm(self.profiler.iterate(loader), total=len(loader)):
+                self.layers.train()
+                with self.profiler.phase('forward'):
+                    scores = self.layers(features)
+                loss = self._step(optimizer, scores, labels, mask)
+                losses.append(loss)
+                self.profiler.step_queries(query_indices)
+
+                # evaluate every eval_freq queries, and after the first batch
+                prev_done = queries_done
+                queries_done += features.shape[0]
                 if eval_freq != 0:
-                    if qid % eval_freq == 0:
-                        print('Loss epoch {}: {} after query {} of {} queries'.format(e, loss.item(), qid,
+                    if prev_done == 0 or queries_done // eval_freq > prev_done // eval_freq:
+                        print('Loss epoch {}: {} after query {} of {} queries'.format(e, loss, queries_done,
                                                                                       num_queries))
-                        with torch.no_grad():
-                            self.layers.eval()
-                            x = torch.Tensor(data.validation.feature_matrix).to(self.device)
-                            validation_scores = self.layers(x).squeeze().numpy()
-                        val_result = evl.evaluate(data.validation, validation_scores)
-                        arrs.append(val_result['arr'][0])
-                        ndcg_result = val_result['ndcg'][0]
+                        with self.profiler.phase('eval'):
+                            converged = validation.step(self.layers, step=(e, queries_done))
+                        arrs.append(validation.last_results['arr'][0])
+                        ndcg_result = validation.last_results['ndcg'][0]
                         validation_results.append(ndcg_result)
                         print('NDCG score: {}'.format(ndcg_result))
-                        if ndcg_result > best_ndcg:
-                            best_ndcg = ndcg_result
-                            no_improvement = 0
-                        else:
-                            no_improvement += 1
-                        if no_improvement >= 8:
-                            converged = True
+                        if checkpointer is not None:
+                            with self.profiler.phase('checkpoint'):
+                                progress = {'epoch': e, 'queries_done': queries_done, 'converged': converged,
+                                            'validation_results': validation_results, 'losses': losses, 'arrs': arrs}
+                                checkpointer.save_evaluation((e, queries_done), self.layers, optimizer, loader,
+                                                             validation, progress)
+                        if converged:
                             print(
-                                'Convergence criteria (NDCG of {}) reached after {} queries of epoch'.format(best_ndcg,
-                                                                                                    qid + 1, e))
+                                'Convergence criteria (NDCG of {}) reached after {} queries of epoch {}'.format(
+                                    validation.best_value, queries_done, e))
                             break
 
         print('Done training for {} epochs'.format(num_epochs))
+        self.profiler.finish()
+        self.validation_results = validation_results
+        # the weights of the best validation NDCG, training ends with the last ones
+        self.best_state = validation.best_state
         with open('valid_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
             pickle.dump(validation_results, f)
         with open('loss_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
              pickle.dump(losses, f)
         with open('arr_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
             pickle.dump(arrs, f)
-        return self.layers, self.evaluate(data.validation)['ndcg']
-
-    def train_sgd(self, data, lr=1e-5, num_epochs=1, eval_freq=1000):
-        self.layers.train()
-        optimizer = torch.optim.Adam(self.layers.parameters(), lr=lr)
-        num_queries = data.train.num_queries()
-        validation_results = []
-        losses = []
-        best_ndcg = 0
-        no_improvement = 0
-        converged = False
-        for e in range(num_epochs):
-            if converged:
-                break
-            random_query_order = np.arange(num_queries)
-            np.random.shuffle(random_query_order)
-            for qid in tqdm(range(num_queries)):
-                x = torch.Tensor(data.train.query_feat(random_query_order[qid])).to(self.device)
-                query_scores = self.layers(x)
-                query_labels = data.train.query_labels(random_query_order[qid])
-
-                # to catch cases with less than two documents (as no loss can be computed if there is no document pair)
-                if len(query_labels) < 2:
-                    continue
-
-                score_combs = list(zip(*product(query_scores, repeat=2)))
-                score_combs_i = torch.stack(score_combs[0]).squeeze()
-                score_combs_j = torch.stack(score_combs[1]).squeeze()
-
-                label_combs = np.array(list(product(query_labels, repeat=2)))
-                label_combs_i = torch.from_numpy(label_combs[:, 0])
-                label_combs_j = torch.from_numpy(label_combs[:, 1])
-
-                loss = self.rank_net_loss(score_combs_i, score_combs_j, label_combs_i, label_combs_j)
-
-                optimizer.zero_grad()
-                loss.backward()
-                losses.append(loss.item())
-                optimizer.step()
-
-                if eval_freq != 0:
-                    if qid % eval_freq == 0:
-                        print('Loss epoch {}: {} after query {} of {} queries'.format(e, loss.item(), qid, num_queries))
-                        with torch.no_grad():
-                            self.layers.eval()
-                            x = torch.Tensor(data.validation.feature_matrix).to(self.device)
-                            validation_scores = self.layers(x).squeeze().numpy()
-                        ndcg_result = evl.evaluate(data.validation, validation_scores)['ndcg'][0]
-                        validation_results.append(ndcg_result)
-                        print('NDCG score: {}'.format(ndcg_result))
-                        if ndcg_result > best_ndcg:
-                            best_ndcg = ndcg_result
-                            no_improvement = 0
-                        else:
-                            no_improvement += 1
-                        if no_improvement >= 8:
-                            converged = True
-                            print(
-                                'Convergence criteria (NDCG of {}) reached after {} queries'.format(best_ndcg, qid + 1))
-                            break
-
-        print('Done training for {} epochs'.format(num_epochs))
-        with open('valid_results_lr_'+ str(lr) +'_'+ self.model_id, 'wb') as f:
-            pickle.dump(validation_results, f)
-        with open('loss_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
-            pickle.dump(losses, f)
-        return self.layers, self.evaluate(data.validation)['ndcg']
-
-    def rank_net_loss(self, s_i, s_j, S_i, S_j):
-        S_diff = S_i - S_j
-        ones = torch.ones_like(S_diff)
-        zeros = torch.zeros_like(S_diff)
-        Sij = torch.where(S_diff > 0, ones, -ones)
-        Sij = torch.where(S_diff == 0, zeros, Sij)
-        sig_diff = self.sigma * (s_i - s_j)
-        return torch.sum(0.5 * (1 - Sij) * sig_diff + torch.log(1 + torch.exp(-sig_diff)))
-
-    def evaluate(self, data_fold, print_results=False):
-        self.layers.eval()
-        with torch.no_grad():
-            x = torch.Tensor(data_fold.feature_matrix).to(self.device)
-            validation_scores = self.layers(x).squeeze().numpy()
-        results = evl.evaluate(data_fold, validation_scores, print_results=print_results)
-        return results
+        return self.layers, self.evaluate(data.validation, in_memory=not streaming)['ndcg']
+
+    def _step(self, optimizer, scores, labels, mask):
+        """
+        Updates the model on one batch of queries, returns the loss per query.
+        """
+        with self.profiler.phase('lambda'):
+            loss = self.rank_net_loss(scores.squeeze(-1), labels, mask) / scores.shape[0]
+        with self.profiler.phase('backward'):
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        return loss.item()
+
+    def rank_net_loss(self, scores, labels, mask=None):
+        return pairwise.rank_net_loss(scores, labels, self.sigma, mask)
+
+    def evaluate(self, data_fold, print_results=False, in_memory=True):
+        return ValidationMonitor(data_fold, device=self.device, in_memory=in_memory).evaluate(
+            self.layers, print_results=print_results)
 
     def save(self, path='./rank_net_'):
         torch.save(self.state_dict(), path+self.model_id+'.weights')
@@ -212,155 +154,28 @@ class Rank_Net_Sped_Up(Rank_Net):
         super(Rank_Net_Sped_Up, self).__init__(d_in, num_neurons, sigma, dropout, device, model_id)
         self.model_id = 'sped_up_'+self.model_id
 
-    def train_bgd(self, data, lr=1e-3, batch_size=500, num_epochs=1, eval_freq=1000):
-        self.layers.train()
-        optimizer = torch.optim.Adam(self.layers.parameters(), lr=lr)
-        num_queries = data.train.num_queries()
-        validation_results = []
-        losses = []
-        arrs = []
-        best_ndcg = 0
-        no_improvement = 0
-        converged = False
-        for e in range(num_epochs):
-            if converged:
-                break
-            random_query_order = np.arange(num_queries)
-            np.random.shuffle(random_query_order)
-            skipped = False
-            for qid in tqdm(range(num_queries)):
-                x = torch.Tensor(data.train.query_feat(random_query_order[qid])).to(self.device)
-                query_scores = self.layers(x)
-                query_labels = data.train.query_labels(random_query_order[qid])
-
-                # to catch cases with less than two documents (as no loss can be computed if there is no document pair)
-                if len(query_labels) < 2:
-                    if qid % batch_size == 1:
-                        skipped = True
-                    continue
-
-                score_combs = list(zip(*product(query_scores.detach(), repeat=2)))
-                score_combs_i = torch.stack(score_combs[0]).squeeze()
-                score_combs_j = torch.stack(score_combs[1]).squeeze()
-
-                label_combs = np.array(list(product(query_labels, repeat=2)))
-                label_combs_i = torch.from_numpy(label_combs[:, 0])
-                label_combs_j = torch.from_numpy(label_combs[:, 1])
-
-                lambda_i = self.rank_net_loss(score_combs_i, score_combs_j,
-                                                label_combs_i, label_combs_j)
-                if qid == 0 or qid % batch_size == 1 or skipped:
-                    batch_lambdas = lambda_i
-                    batch_scores = query_scores
-                    skipped = False
-                else:
-                    batch_lambdas = torch.cat((batch_lambdas, lambda_i), 0)
-                    batch_scores = torch.cat((batch_scores, query_scores), 0)
-
-                if qid % batch_size == 0 or qid == num_queries - 1:
-                    optimizer.zero_grad()
-                    batch_scores.backward(batch_lambdas)
-                    losses.append(batch_lambdas.mean().item())
-                    optimizer.step()
-
-                if eval_freq != 0:
-                    if qid % eval_freq == 0:
-                        val_result = self.evaluate(data.validation)
-                        arrs.append(val_result['arr'][0])
-                        ndcg_result = val_result['ndcg'][0]
-                        validation_results.append(ndcg_result)
-                        print('NDCG score: {}'.format(ndcg_result))
-                        if ndcg_result > best_ndcg:
-                            best_ndcg = ndcg_result
-                            no_improvement = 0
-                        else:
-                            no_improvement += 1
-                        if no_improvement >= 8:
-                            converged = True
-                            print(
-                                'Convergence criteria (NDCG of {}) reached after {} queries'.format(best_ndcg,qid+1))
-                            break
-
-        print('Done training for {} epochs'.format(num_epochs))
-        with open('valid_results_lr_'+ str(lr) +'_'+ self.model_id, 'wb') as f:
-            pickle.dump(validation_results, f)
-        with open('loss_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
-             pickle.dump(losses, f)
-        with open('arr_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
-            pickle.dump(arrs, f)
-        return self.layers, self.evaluate(data.validation)['ndcg']
-
-    def train_sgd(self, data, lr=5e-5, num_epochs=1, eval_freq=1000):
-        self.layers.train()
-        optimizer = torch.optim.Adam(self.layers.parameters(), lr=lr)
-        num_queries = data.train.num_queries()
-        validation_results = []
-        losses = []
-        best_ndcg = 0
-        no_improvement = 0
-        converged = False
-        for e in range(num_epochs):
-            if converged:
-                break
-            random_query_order = np.arange(num_queries)
-            np.random.shuffle(random_query_order)
-            for qid in tqdm(range(num_queries)):
-                x = torch.Tensor(data.train.query_feat(random_query_order[qid])).to(self.device)
-                query_scores = self.layers(x)
-                query_labels = data.train.query_labels(random_query_order[qid])
-
-                # to catch cases with less than two documents (as no loss can be computed if there is no document pair)
-                if len(query_labels) < 2:
-                    continue
-
-                score_combs = list(zip(*product(query_scores.detach(), repeat=2)))
-                score_combs_i = torch.stack(score_combs[0]).squeeze()
-                score_combs_j = torch.stack(score_combs[1]).squeeze()
-
-                label_combs = np.array(list(product(query_labels, repeat=2)))
-                label_combs_i = torch.from_numpy(label_combs[:, 0])
-                label_combs_j = torch.from_numpy(label_combs[:, 1])
-
-                lambda_i = self.rank_net_loss(score_combs_i, score_combs_j,
-                                                label_combs_i, label_combs_j)
-
-                optimizer.zero_grad()
-                query_scores.backward(lambda_i)
-                losses.append(lambda_i.mean().item())
-                optimizer.step()
-
-
-                if eval_freq != 0:
-                    if qid % eval_freq == 0:
-                        ndcg_result = self.evaluate(data.validation)['ndcg'][0]
-                        validation_results.append(ndcg_result)
-                        print('NDCG score: {}'.format(ndcg_result))
-                        if ndcg_result > best_ndcg:
-                            best_ndcg = ndcg_result
-                            no_improvement = 0
-                        else:
-                            no_improvement += 1
-                        if no_improvement >= 8:
-                            converged = True
-                            print(
-                                'Convergence criteria (NDCG of {}) reached after {} queries'.format(best_ndcg, qid + 1))
-                            break
-
-        print('Done training for {} epochs'.format(num_epochs))
-        with open('valid_results_lr_'+ str(lr) +'_'+ self.model_id, 'wb') as f:
-            pickle.dump(validation_results, f)
-        with open('loss_results_lr_' + str(lr)+'_'+self.model_id, 'wb') as f:
-            pickle.dump(losses, f)
-        return self.layers, self.evaluate(data.validation)['ndcg']
-
-    def rank_net_loss(self, s_i, s_j, S_i, S_j):
-        S_diff = S_i - S_j
-        Sij = np.where(S_diff > 0, 1.0, -1.0)
-        Sij = torch.from_numpy(np.where(S_diff == 0, 0.0, Sij))
-        sig_diff = self.sigma * (s_i - s_j)
-        num_docs = int(math.sqrt(s_i.shape[0]))
-        lambda_ij = (self.sigma * (0.5 * (1 - Sij) - 1/(1 + torch.exp(sig_diff)))).view(num_docs,num_docs)
-        return torch.sum(lambda_ij, dim=1).unsqueeze_(dim=1)
+    def train_bgd(self, data, lr=1e-3, batch_size=500, num_epochs=1, eval_freq=1000, streaming=False, callback=None,
+                  checkpoint_dir=None, trace_dir=None):
+        return self._train(data, lr, batch_size, num_epochs, eval_freq, streaming, callback, checkpoint_dir,
+                           trace_dir)
+
+    def train_sgd(self, data, lr=5e-5, num_epochs=1, eval_freq=1000, streaming=False, callback=None,
+                  checkpoint_dir=None, trace_dir=None):
+        return self._train(data, lr, 1, num_epochs, eval_freq, streaming, callback, checkpoint_dir, trace_dir)
+
+    def _step(self, optimizer, scores, labels, mask):
+        # the lambdas of all queries in the batch are used as the gradients of their scores
+        with self.profiler.phase('lambda'):
+            lambdas = self.rank_net_loss(scores.detach().squeeze(-1), labels, mask)
+        with self.profiler.phase('backward'):
+            optimizer.zero_grad()
+            scores.backward(lambdas)
+            optimizer.step()
+        return lambdas.squeeze(-1)[mask].mean().item()
+
+    def rank_net_loss(self, scores, labels, mask=None):
+        # the sped-up version directly returns the lambdas, i.e. the gradients of the scores
+        return pairwise.rank_net_lambdas(scores, labels, self.sigma, mask).unsqueeze(-1)
 
 def hyperparameter_search():
     lrs = [2e-3, 1e-3, 5e-4]
@@ -54,11 +54,16 @@ def data_split_rank_and_invert(scores, data_split):
                  s_i, e_i = data_split.query_range(qid)
                  query_ranking = ranking[s_i:e_i]  
   """
-  ranking = np.zeros(data_split.num_docs(), dtype=np.int64)
-  inverted = np.zeros(data_split.num_docs(), dtype=np.int64)
-  for qid in np.arange(data_split.num_queries()):
-    s_i, e_i = data_split.query_range(qid)
-    q_scores = scores[s_i:e_i]
-    (ranking[s_i:e_i],
-     inverted[s_i:e_i]) = rank_and_invert(q_scores)
+  n_docs = data_split.num_docs()
+  sizes = data_split.query_sizes()
+  # the start of the query of every document
+  offsets = np.repeat(data_split.doclist_ranges[:-1], sizes)
+  doc_query = np.repeat(np.arange(data_split.num_queries()), sizes)
+  noise = np.random.uniform(size=n_docs)
+  # A single sort over the whole split, reversed like in rank_and_invert,
+  # so queries have to be sorted on descending -query_index to stay in order.
+  order = np.lexsort((noise, scores, -doc_query))[::-1]
+  ranking = order - offsets
+  inverted = np.empty(n_docs, dtype=np.int64)
+  inverted[order] = np.arange(n_docs) - offsets
   return ranking, inverted
\ No newline at end of file
@@ -0,0 +1,166 @@
+import argparse
+import os
+import pickle as pkl
+
+import dataset
+import listwise
+from pointwise import MLP
+from monitor import ValidationMonitor
+from checkpoint import resume_run
+from profiling import StepProfiler
+
+import torch
+import torch.optim as optim
+
+# Default constants
+LEARNING_RATE_DEFAULT = 1e-3
+N_HIDDENS_DEFAULT     = "200,100"
+NUM_EPOCHS_DEFAULT    = 5
+BATCH_SIZE_DEFAULT    = 100
+EVAL_FREQ_DEFAULT     = 20
+LOSS_DEFAULT          = "approx_ndcg"
+TEMPERATURE_DEFAULT   = 1.0
+
+# number of evaluations without improvement of the validation nDCG before training stops
+PATIENCE = 10
+
+FLAGS = None
+
+def save_results(results):
+
+    if not os.path.exists("results"):
+        os.mkdir("results")
+    hiddens = "-".join(FLAGS.n_hiddens.split(","))
+    with open(f"results/{FLAGS.loss}_lr{FLAGS.learning_rate}_nhiddens{hiddens}.pkl", "wb") as f:
+        pkl.dump(results, f)
+
+def train():
+
+    if FLAGS.n_hiddens:
+        n_hiddens = [int(n_hidden) for n_hidden in FLAGS.n_hiddens.split(",")]
+    else:
+        n_hiddens = []
+
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+
+    print("Reading data...")
+    data = dataset.get_dataset().get_data_folds()[0]
+    data.read_data()
+    print("Done!")
+
+    print("Preparing training...")
+    # padded batches of whole queries, queries without relevant documents give no gradient for approx_ndcg
+    loader = dataset.query_loader(data.train, batch_size=FLAGS.batch_size, shuffle=True,
+                                  device=device, streaming=FLAGS.streaming)
+    validation = ValidationMonitor(data.validation, metric="ndcg", metrics=["ndcg", "err"], patience=PATIENCE,
+                                   device=device, in_memory=not FLAGS.streaming)
+
+    model = MLP(data.num_features, n_hiddens).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=FLAGS.learning_rate)
+    loss_fn = listwise.LOSSES[FLAGS.loss]
+    results = {"train":{"loss":[]}, "validation":{"ndcg":[], "err":[]}, "test":{},
+               "loss":FLAGS.loss, "learning_rate":FLAGS.learning_rate, "n_hiddens":FLAGS.n_hiddens,
+               "batch_size":FLAGS.batch_size, "eval_freq":FLAGS.eval_freq}
+    start_epoch = 0
+    step = 0
+    # checkpoints are written at the evaluations, the step after the last one is where training resumes
+    checkpointer, state = resume_run(FLAGS.checkpoint_dir, model, optimizer, loader, validation)
+    if state is not None:
+        start_epoch, step = state["step"]
+        step += 1
+        results = state["extra"]["results"]
+    print("Done!")
+
+    print("Training...")
+    # the listwise loss is timed as the "lambda" phase, so the summary compares to the pairwise trainers
+    profiler = StepProfiler(device, FLAGS.trace_dir, data.train)
+    for epoch in range(start_epoch, FLAGS.num_epochs):
+        # a run resumed after early stopping does not train any further
+        if validation.stopped:
+            break
+        for features, labels, mask, query_indices in profiler.iterate(loader):
+            model.train()
+            with profiler.phase("forward"):
+                scores = model(features).squeeze(-1)
+            # the listwise loss takes the place of the lambdas
+            with profiler.phase("lambda"):
+                if FLAGS.loss == "approx_ndcg":
+                    # the ideal dcg of every query is precomputed by the split
+                    query_dcg = torch.from_numpy(data.train.ideal_dcg[query_indices, 0]).float().to(device)
+                    loss = loss_fn(scores, labels, mask, FLAGS.temperature, query_dcg)
+                else:
+                    loss = loss_fn(scores, labels, mask)
+                loss = loss / features.shape[0]
+
+            with profiler.phase("backward"):
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            profiler.step_queries(query_indices)
+            results["train"]["loss"].append(loss.item())
+
+            if step % FLAGS.eval_freq == 0:
+                with profiler.phase("eval"):
+                    validation.step(model, (epoch, step))
+                results["validation"]["ndcg"].append(validation.last_results["ndcg"][0])
+                results["validation"]["err"].append(validation.last_results["err"][0])
+                print(f"[{epoch}] {step} | loss: {round(loss.item(),4)} | "
+                      f"nDCG: {round(validation.last_results['ndcg'][0],3)} | "
+                      f"{int(profiler.summary()['docs_per_second'])} docs/s")
+                if checkpointer is not None:
+                    with profiler.phase("checkpoint"):
+                        checkpointer.save_evaluation((epoch, step), model, optimizer, loader, validation,
+                                                     {"results":results})
+            step += 1
+            if validation.stopped:
+                break
+    if validation.stopped:
+        print(f"No improvement of the validation nDCG over the previous {PATIENCE} evaluations.")
+
+    results["profile"] = profiler.finish()
+
+    # the test results are of the model with the best validation nDCG
+    validation.restore_best(model)
+    test_results = ValidationMonitor(data.test, device=device, in_memory=not FLAGS.streaming).evaluate(model)
+    results["test"] = test_results
+    test_ndcg, test_ndcg_std = test_results["ndcg"]
+    print(f"Test nDCG: {round(test_ndcg,3)} +/- {round(test_ndcg_std,3)}")
+    save_results(results)
+    print("Done!")
+
+
+def print_flags():
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+def main():
+    print_flags()
+    train()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loss', choices=sorted(listwise.LOSSES), default=LOSS_DEFAULT,
+                        help='Listwise loss to train with')
+    parser.add_argument('--learning_rate', type=float, default=LEARNING_RATE_DEFAULT,
+                        help='Learning rate')
+    parser.add_argument('--n_hiddens', type=str, default=N_HIDDENS_DEFAULT,
+                        help='Comma separated list of number of units in each hidden layer')
+    parser.add_argument('--num_epochs', type=int, default=NUM_EPOCHS_DEFAULT,
+                        help='Number of passes over the train queries')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE_DEFAULT,
+                        help='Number of queries per batch')
+    parser.add_argument('--eval_freq', type=int, default=EVAL_FREQ_DEFAULT,
+                        help='Frequency of evaluation on the validation set, in batches')
+    parser.add_argument('--temperature', type=float, default=TEMPERATURE_DEFAULT,
+                        help='Temperature of the approximate ranks of approx_ndcg')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read the queries from disk instead of keeping the split in memory')
+    parser.add_argument('--checkpoint_dir', type=str, default=None,
+                        help='Directory to save checkpoints in and resume training from')
+    parser.add_argument('--trace_dir', type=str, default=None,
+                        help='Directory to write a torch.profiler trace of a few training steps to, '
+                             'the phases of the steps are then also synchronized with the GPU')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
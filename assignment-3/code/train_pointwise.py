@@ -13,6 +13,9 @@ import matplotlib.pyplot as plt
 
 import dataset
 from dataset import DataClass
+from monitor import ValidationMonitor
+from checkpoint import resume_run
+from profiling import StepProfiler
 
 import torch
 import torch.nn as nn
@@ -77,15 +80,16 @@ def train():
     
     print("Preparing training...")
     #train set for batched training
-    train  = DataClass(data.train.feature_matrix, data.train.label_vector, shuffle=True)
+    train  = DataClass(data.train.feature_matrix, data.train.label_vector, shuffle=True,
+                       stratified=FLAGS.stratified, prefetch=FLAGS.prefetch)
     
     #entire train set
     xtrain = torch.from_numpy(data.train.feature_matrix).float().to(device)
     ttrain = torch.from_numpy(data.train.label_vector).float().view(-1,1).to(device)
     
-    #entire validation set
-    xval = torch.from_numpy(data.validation.feature_matrix).float().to(device)
-    tval = torch.from_numpy(data.validation.label_vector).float().view(-1,1).to(device)
+    #entire validation set, converted to tensors once
+    validation = ValidationMonitor(data.validation, metric="ndcg", device=device)
+    tval = validation.labels.view(-1,1)
     
     #entire test set
     xtest = torch.from_numpy(data.test.feature_matrix).float().to(device)
@@ -100,47 +104,62 @@ def train():
     results = {"train":{"loss":[]}, "validation":{"loss":[],"ndcg":[]}, "test":{},
                "learning_rate":learning_rate, "n_hiddens":FLAGS.n_hiddens,
                "batch_size":batch_size, "eval_freq":eval_freq}
+    start_step = 0
+    #the sampling state of the train batches is checkpointed as well, so a resumed run draws the same batches
+    checkpointer, state = resume_run(FLAGS.checkpoint_dir, model, optimizer, train, validation)
+    if state is not None:
+        start_step = state["step"] + 1
+        results = state["extra"]["results"]
     print("Done!")
     
     print("Training...")
-    for step in range(max_steps):
+    #batches are documents, not queries, so only documents per second are reported
+    profiler = StepProfiler(device, FLAGS.trace_dir)
+    for step in range(start_step, max_steps):
     
         optimizer.zero_grad()
     
-        x, t = train.next_batch(batch_size)
-        x = x.requires_grad_(True).to(device)
-        t = t.to(device)
+        with profiler.phase("data"):
+            x, t = train.next_batch(batch_size)
+            x = x.to(device, non_blocking=True)
+            t = t.to(device, non_blocking=True)
         
-        y = model(x).to(device)
-        loss = criterion(y, t)
-    
-        loss.backward() 
-        optimizer.step()
+        with profiler.phase("forward"):
+            y = model(x).to(device)
+            loss = criterion(y, t)
+    
+        with profiler.phase("backward"):
+            loss.backward() 
+            optimizer.step()
+        profiler.step(num_docs=x.shape[0])
         
         results["train"]["loss"].append(loss.detach())
         
         if step % eval_freq == 0 or step == max_steps-1:
-            with torch.no_grad():
-                yval = model(xval)
-                val_results = evl.evaluate(data.validation, np.array(yval).squeeze(), print_results=False)
-                val_ndcg, val_ndcg_std = val_results["ndcg"]
-                lossval = criterion(yval.to(device), tval)
-                results["validation"]["loss"].append(lossval)
-                results["validation"]["ndcg"].append(val_ndcg) 
+            with profiler.phase("eval"):
+                validation.step(model, step)
+            val_ndcg, val_ndcg_std = validation.last_results["ndcg"]
+            lossval = criterion(validation.last_scores.view(-1,1), tval)
+            results["validation"]["loss"].append(lossval)
+            results["validation"]["ndcg"].append(val_ndcg) 
             if step == max_steps-1:
                 print(f"[{train.epochs_completed}] {step+1}/{max_steps} | nDCG: {round(val_ndcg,3)}")
             else:
                 print(f"[{train.epochs_completed}] {step}/{max_steps} | nDCG: {round(val_ndcg,3)}")
+            if checkpointer is not None:
+                with profiler.phase("checkpoint"):
+                    checkpointer.save_evaluation(step, model, optimizer, train, validation, {"results":results})
             #early stopping
             if len(results["validation"]["ndcg"]) > CONVERGENCE*2:
                 prev = results["validation"]["ndcg"]
                 if np.round(np.mean(prev[-2*CONVERGENCE:-CONVERGENCE]),3)==np.round(np.mean(prev[-CONVERGENCE:]),3):
                     print(f"Changes very small over previous {CONVERGENCE*2} iterations.")
                     break
+    results["profile"] = profiler.finish()
     
     with torch.no_grad():
         ytest = model(xtest)
-        yval = model(xval)
+        yval = validation.score(model).view(-1,1)
         test_results = evl.evaluate(data.test, np.array(ytest).squeeze(), print_results=False)
         test_ndcg, test_ndcg_std = test_results["ndcg"]
         results["test"]["ndcg"] = test_ndcg
@@ -162,7 +181,10 @@ def main():
 
 if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description='Pointwise training samples documents from the whole train split, so unlike the query '
+                    'trainers (--streaming of rank_net, lambda_rank and train_listwise) the train, validation '
+                    'and test splits are kept in memory.')
     parser.add_argument('--learning_rate', type = float, default = LEARNING_RATE_DEFAULT,
                       help='Learning rate')
     parser.add_argument('--n_hiddens', type = str, default = N_HIDDENS_DEFAULT,
@@ -173,6 +195,15 @@ if __name__ == '__main__':
                       help='Batch size to run trainer.')
     parser.add_argument('--eval_freq', type=int, default=EVAL_FREQ_DEFAULT,
                         help='Frequency of evaluation on the test set')
+    parser.add_argument('--stratified', action='store_true',
+                        help='Sample batches with the label distribution of the train set')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches to prepare in a background thread')
+    parser.add_argument('--checkpoint_dir', type=str, default=None,
+                        help='Directory to save checkpoints in and resume training from')
+    parser.add_argument('--trace_dir', type=str, default=None,
+                        help='Directory to write a torch.profiler trace of a few training steps to, '
+                             'the phases of the steps are then also synchronized with the GPU')
     FLAGS, unparsed = parser.parse_known_args()
 
     main()